@@ -0,0 +1,256 @@
+# admission.py
+# -*- coding: utf-8 -*-
+"""
+Per-route admission control: a token-bucket rate limit per client plus an
+optional concurrency cap (used for PDF rendering).
+
+  admission = AdmissionControl(app)
+
+  @app.route("/download_pdf")
+  @admission.limit("download_pdf", concurrent=True)
+  def download_pdf(): ...
+
+Config (app.config):
+  RATE_LIMITS          {"route name": (tokens per second, burst)}; missing = unlimited
+  CONCURRENCY          {"route name": max in-flight requests}, per worker with
+                       the memory backend, per host with the SQLite one
+  ADMISSION_BACKEND    "memory" (per worker) or a path to a SQLite file shared
+                       by all workers on the host
+  ADMISSION_CLIENT_KEY function () -> key a client's buckets are kept under;
+                       default request.remote_addr, which is the proxy's address
+                       behind nginx unless the app applies ProxyFix
+
+Rejected requests get 429 (rate) or 503 (concurrency) with Retry-After.
+Counters per route are available from stats().
+"""
+import math
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import wraps
+
+from flask import request, make_response
+
+DEFAULT_RATE_LIMITS = {
+    "submit": (1.0, 10),          # 1 plan/s per client, bursts of 10
+    "download_pdf": (0.2, 3),     # 1 PDF every 5 s per client, bursts of 3
+    "group_plan": (0.5, 5),       # cohort plans are heavier; 1 every 2 s, bursts of 5
+    "jobs": (0.1, 3),             # background batch jobs; 1 every 10 s, bursts of 3
+}
+DEFAULT_CONCURRENCY = {
+    "download_pdf": 2,
+}
+# a concurrency slot whose holder died is given back after this long
+SLOT_TTL = 300.0
+
+
+def remote_addr():
+    return request.remote_addr
+
+
+###############################################################################
+# Token bucket backends
+###############################################################################
+
+class MemoryBackend:
+    """
+    Buckets and concurrency slots in this process only. take() returns
+    (allowed, retry_after_s); acquire() a slot token or None.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}   # key -> (tokens, last_refill)
+        self._in_flight = Counter()
+        self._lock = threading.Lock()
+
+    def acquire(self, name, limit):
+        with self._lock:
+            if self._in_flight[name] >= limit:
+                return None
+            self._in_flight[name] += 1
+            return name
+
+    def release(self, name, token):
+        with self._lock:
+            self._in_flight[name] -= 1
+
+    def take(self, key, rate, burst, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._evict(now, rate, burst)
+            self._buckets[key] = (tokens, now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def _evict(self, now, rate, burst):
+        # drop buckets that have refilled completely; they carry no state
+        full = [k for k, (t, last) in self._buckets.items() if t + (now - last) * rate >= burst]
+        for k in full or list(self._buckets)[: len(self._buckets) // 10]:
+            del self._buckets[k]
+
+
+class SQLiteBackend:
+    """
+    Buckets and concurrency slots in a SQLite file so every worker on the
+    host shares the limits. Uses wall-clock time since monotonic clocks
+    differ between processes.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS concurrency_slots (
+        token TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        expires REAL NOT NULL
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            self._local.con = con
+        return con
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        con = self._conn()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, last = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - last) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            con.execute(
+                "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def acquire(self, name, limit, now=None):
+        now = time.time() if now is None else now
+        con = self._conn()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute("DELETE FROM concurrency_slots WHERE expires < ?", (now,))
+            in_flight = con.execute("SELECT COUNT(*) FROM concurrency_slots WHERE name = ?", (name,)).fetchone()[0]
+            token = None
+            if in_flight < limit:
+                token = uuid.uuid4().hex
+                con.execute("INSERT INTO concurrency_slots (token, name, expires) VALUES (?, ?, ?)",
+                            (token, name, now + SLOT_TTL))
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return token
+
+    def release(self, name, token):
+        try:
+            self._conn().execute("DELETE FROM concurrency_slots WHERE token = ?", (token,))
+        except sqlite3.OperationalError:
+            pass   # busy: the slot lapses after SLOT_TTL instead
+
+
+###############################################################################
+# Flask integration
+###############################################################################
+
+class AdmissionControl:
+    def __init__(self, app=None, backend=None):
+        self.backend = backend
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RATE_LIMITS", dict(DEFAULT_RATE_LIMITS))
+        app.config.setdefault("CONCURRENCY", dict(DEFAULT_CONCURRENCY))
+        app.config.setdefault("ADMISSION_BACKEND", "memory")
+        app.config.setdefault("ADMISSION_CLIENT_KEY", remote_addr)
+        self.app = app
+
+    def _backend(self):
+        if self.backend is None:
+            setting = self.app.config["ADMISSION_BACKEND"]
+            self.backend = MemoryBackend() if setting == "memory" else SQLiteBackend(setting)
+        return self.backend
+
+    def _count(self, name, outcome):
+        with self._lock:
+            self.counters[(name, outcome)] += 1
+
+    def stats(self):
+        """
+        {"route": {"allowed": n, "rate_limited": n, "shed": n}}
+        """
+        out = {}
+        with self._lock:
+            for (name, outcome), n in self.counters.items():
+                out.setdefault(name, {"allowed": 0, "rate_limited": 0, "shed": 0})[outcome] = n
+        return out
+
+    @staticmethod
+    def _reject(status, message, retry_after):
+        resp = make_response(message, status)
+        resp.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+        return resp
+
+    def limit(self, name, concurrent=False):
+        """
+        Decorator: rate-limit `name` per client and, if `concurrent`, cap
+        in-flight requests with CONCURRENCY[name].
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                rule = self.app.config["RATE_LIMITS"].get(name)
+                if rule:
+                    rate, burst = rule
+                    client = self.app.config["ADMISSION_CLIENT_KEY"]()
+                    allowed, retry_after = self._backend().take(f"{name}:{client}", rate, burst)
+                    if not allowed:
+                        self._count(name, "rate_limited")
+                        return self._reject(429, "Too many requests, please slow down.", retry_after)
+
+                cap = self.app.config["CONCURRENCY"].get(name) if concurrent else None
+                slot = None
+                if cap:
+                    slot = self._backend().acquire(name, cap)
+                    if slot is None:
+                        self._count(name, "shed")
+                        return self._reject(503, "Server busy, please retry shortly.", 2)
+                self._count(name, "allowed")
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    if slot is not None:
+                        self._backend().release(name, slot)
+            return wrapper
+        return decorator
@@ -1,8 +1,11 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, make_response
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, make_response, jsonify, Response
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timezone
+import hmac
 import json
+import os
 from pathlib import Path
 from io import BytesIO
 
@@ -25,12 +28,36 @@ from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 
 # your diet generator - must return (plan_dict, profile_dict)
-from diet_generator import generate_plan
+from diet_generator import generate_plan, generate_group_plan, upgrade_plan, DRESS_VERSION
+from compact_plan import CompactPlan, compact_plan
+from reports import summary as reports_summary
+from profile_schema import parse_form, ProfileError
+from admission import AdmissionControl
+from profiling import init_profiling
+from plan_store import init_plan_store, put_plan, get_plan
+from archive import init_archive, case_signature
+from warmup import warm_up, STATE as WARMUP_STATE
+from jobs import JobRegistry, stream_events
+from batch import iter_run, count_pending
+from http_cache import init_http_cache, asset_file_url, content_etag, template_fingerprint, conditional, cache_private
 
 app = Flask(__name__)
 app.secret_key = "secret123"
+# bearer token for admin-only operations (regenerate jobs); unset = disabled
+app.config.setdefault("ADMIN_TOKEN", os.environ.get("DIET_ADMIN_TOKEN"))
+# reverse proxies (nginx) in front of gunicorn; with 1+ request.remote_addr,
+# and so each client's rate-limit bucket, comes from X-Forwarded-For. Leave
+# at 0 when clients reach gunicorn directly, or they could pick their address.
+app.config.setdefault("TRUSTED_PROXIES", int(os.environ.get("DIET_TRUSTED_PROXIES", "0")))
+if app.config["TRUSTED_PROXIES"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"], x_proto=1)
+admission = AdmissionControl(app)
+init_profiling(app)  # registered first so its timing includes compression
+init_http_cache(app)
 
 DB_PATH = Path("database.db")
+# job state lives in the database, so every worker can serve /jobs/<id>
+jobs = JobRegistry(DB_PATH)
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS user_cases (
@@ -49,7 +76,10 @@ CREATE TABLE IF NOT EXISTS user_cases (
     thyroid TEXT,
     plan TEXT,
     plan_source TEXT,
-    created_at TEXT
+    created_at TEXT,
+    profile TEXT,
+    plan_hash TEXT,
+    signature TEXT
 )
 """
 
@@ -57,102 +87,285 @@ def init_db():
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute(SCHEMA)
+    # older databases predate the full profile JSON column
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(user_cases)")]
+    if "profile" not in columns:
+        cursor.execute("ALTER TABLE user_cases ADD COLUMN profile TEXT")
+    init_plan_store(conn)
+    init_archive(conn)
     conn.commit()
     conn.close()
 
 init_db()
 
+def save_case(conn, profile, plan, plan_source):
+    """
+    Insert one user_cases row (plan content goes to the plan store) and
+    return (case id, plan hash). Runs inside the caller's transaction.
+    """
+    plan_hash = put_plan(conn, plan)
+    cursor = conn.execute(
+        """INSERT INTO user_cases
+        (name, age, gender, weight, height, sleep, activity, stress, work_type,
+         bp, sugar, thyroid, plan_hash, plan_source, created_at, profile, signature)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            profile["name"], profile["age"], profile["gender"], profile["weight"],
+            profile["height"], profile["sleep"], profile["activity"], profile["stress"],
+            profile["work_type"], profile["bp"], profile["sugar"], profile["thyroid"],
+            plan_hash, plan_source, datetime.now().isoformat(),
+            json.dumps(profile), case_signature(profile)
+        ),
+    )
+    return cursor.lastrowid, plan_hash
+
 # ----------------- ROUTES -------------------
 @app.route("/")
 def index():
     return render_template("index.html")
 
 @app.route("/submit", methods=["POST"])
+@admission.limit("submit")
 def submit():
-    # Basic fields
-    name = request.form.get("name", "").strip()
-    age = int(request.form.get("age") or 0)
-    gender = request.form.get("gender", "")
-    weight = float(request.form.get("weight") or 0)
-    height = float(request.form.get("height") or 0)
-    sleep = float(request.form.get("sleep") or 0)
-    activity = request.form.get("activity", "low")
-    stress = request.form.get("stress", "low")
-    work_type = request.form.get("work_type", "")
-
-    # Goals & prefs (optional in your form)
-    goal = request.form.get("goal", "fitness").lower()
-    diet_pref = (request.form.get("diet_pref") or "both").lower()
-    allergies = (request.form.get("allergies") or "").strip()
-
-    # Conditions coming from your form
-    bp = request.form.get("bp", "normal").lower()
-    sugar = request.form.get("sugar", "none").lower()
-    thyroid = request.form.get("thyroid", "none").lower()
-    pcod = request.form.get("pcod", "no").lower()
-    cholesterol = request.form.get("cholesterol", "normal").lower()
-    heart = request.form.get("heart", "no").lower()
-    kidney = request.form.get("kidney", "no").lower()
-    pregnancy = request.form.get("pregnancy", "na").lower()
-
-    # Build a profile dict
-    profile = {
-        "name": name,
-        "age": age,
-        "gender": gender,
-        "weight": weight,
-        "height": height,
-        "sleep": sleep,
-        "activity": activity,
-        "stress": stress,
-        "work_type": work_type,
-        "goal": goal,
-        "diet_pref": diet_pref,
-        "allergies": [a.strip().lower() for a in allergies.split(",") if a.strip()],
-        "bp": bp,
-        "sugar": sugar,
-        "thyroid": thyroid,
-        "pcod": pcod,
-        "cholesterol": cholesterol,
-        "heart": heart,
-        "kidney": kidney,
-        "pregnancy": pregnancy,
-    }
+    # Parse + validate once; bad input is rejected before any plan work
+    try:
+        form_profile = parse_form(request.form)
+    except ProfileError as e:
+        return make_response(str(e), 400)
 
     # Generate the plan (returns dicts)
-    plan, profile = generate_plan(profile)
+    plan, profile = generate_plan(form_profile)
 
     # ---- Save into DB ----
     conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO user_cases
-        (name, age, gender, weight, height, sleep, activity, stress, work_type,
-         bp, sugar, thyroid, plan, plan_source, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (
-            name, age, gender, weight, height, sleep, activity, stress, work_type,
-            bp, sugar, thyroid, json.dumps(plan), "Auto-generated", datetime.now().isoformat()
-        ),
-    )
+    # plan content is stored once in the plan store; the case keeps its hash
+    save_case(conn, profile, plan, "Auto-generated")
     conn.commit()
     conn.close()
 
-    # Save in session
+    # Save in session (compact form; expanded again only when rendering)
+    compact = compact_plan(plan, profile)
     session["latest_profile"] = profile
-    session["latest_plan"] = plan
+    session["latest_plan"] = compact.to_json() if compact else plan
     session["plan_source"] = "Auto-generated"
+    session["plan_created"] = datetime.now(timezone.utc).replace(microsecond=0)
 
     return redirect(url_for("result"))
 
+MAX_GROUP_SIZE = 50
+
+@app.route("/group_plan", methods=["POST"])
+@admission.limit("group_plan")
+def group_plan():
+    """
+    JSON {"members": [{form fields}, ...]} -> one shared plan for the group.
+    """
+    body = request.get_json(silent=True) or {}
+    members = body.get("members")
+    if not isinstance(members, list) or not members:
+        return make_response("Expected a non-empty 'members' list", 400)
+    if len(members) > MAX_GROUP_SIZE:
+        return make_response(f"At most {MAX_GROUP_SIZE} members per group", 400)
+    try:
+        profiles = [parse_form(m if isinstance(m, dict) else {}) for m in members]
+    except ProfileError as e:
+        return make_response(str(e), 400)
+
+    plan, profiles = generate_group_plan(profiles)
+    return jsonify({"plan": plan, "profiles": profiles})
+
+# -------- BACKGROUND JOBS ----------
+MAX_JOB_ITEMS = 5000
+JOB_CHUNK = 100   # generated plans per transaction
+
+def _generate_cases(profiles):
+    """
+    Job work: generate + store a plan per profile, one transaction per chunk.
+    """
+    def work(job):
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            for lo in range(0, len(profiles), JOB_CHUNK):
+                out = []
+                with conn:
+                    for i, form_profile in enumerate(profiles[lo:lo + JOB_CHUNK], lo):
+                        plan, profile = generate_plan(form_profile)
+                        case_id, plan_hash = save_case(conn, profile, plan, "Bulk generated")
+                        # ids only: the job keeps up to 10k results for an hour;
+                        # the plan itself is at /plans/<plan_hash>
+                        out.append({"index": i, "case_id": case_id, "plan_hash": plan_hash})
+                        if job.cancelled:
+                            break
+                # results are reported only once their rows are committed
+                yield from out
+                if job.cancelled:
+                    return
+        finally:
+            conn.close()
+    return work
+
+def _regenerate_cases(name, workers):
+    def work(job):
+        for pairs in iter_run(name, DB_PATH, workers=workers, chunk=JOB_CHUNK, log=app.logger.info):
+            for case_id, plan_hash in pairs:
+                yield {"case_id": case_id, "plan_hash": plan_hash}
+            if job.cancelled:
+                return   # checkpoint is at this chunk; the same name resumes here
+    return work
+
+def _is_admin():
+    """
+    Request carries `Authorization: Bearer <ADMIN_TOKEN>`; always False
+    while ADMIN_TOKEN is unset.
+    """
+    token = app.config["ADMIN_TOKEN"]
+    return bool(token) and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+@app.route("/jobs", methods=["POST"])
+@admission.limit("jobs")
+def start_job():
+    """
+    {"kind": "generate", "members": [{form fields}, ...]}
+    {"kind": "regenerate", "name": "<checkpoint name>", "workers": n}   admin only
+    -> 202 with the job id; follow /jobs/<id>/events for progress.
+    """
+    body = request.get_json(silent=True) or {}
+    kind = body.get("kind")
+    if kind == "generate":
+        members = body.get("members")
+        if not isinstance(members, list) or not members:
+            return make_response("Expected a non-empty 'members' list", 400)
+        if len(members) > MAX_JOB_ITEMS:
+            return make_response(f"At most {MAX_JOB_ITEMS} members per job", 400)
+        try:
+            profiles = [parse_form(m if isinstance(m, dict) else {}) for m in members]
+        except ProfileError as e:
+            return make_response(str(e), 400)
+        total, work = len(profiles), _generate_cases(profiles)
+    elif kind == "regenerate":
+        # rewrites every stored plan; `python batch.py` does the same from a shell
+        if not _is_admin():
+            return make_response("Regenerate jobs need the admin token", 403)
+        name = str(body.get("name") or "").strip()
+        if not name:
+            return make_response("Expected a checkpoint 'name'", 400)
+        try:
+            workers = max(1, min(int(body.get("workers") or 1), os.cpu_count() or 1))
+        except (TypeError, ValueError):
+            return make_response("'workers' must be a number", 400)
+        total, work = count_pending(name, DB_PATH), _regenerate_cases(name, workers)
+    else:
+        return make_response("Unknown job kind", 400)
+
+    job = jobs.submit(kind, total, work)
+    if job is None:
+        resp = make_response("Too many jobs running, please retry shortly.", 503)
+        resp.headers["Retry-After"] = "10"
+        return resp
+    events = url_for("job_events", job_id=job.id)
+    resp = jsonify({**job.progress(), "status_url": url_for("job_status", job_id=job.id), "events_url": events})
+    resp.status_code = 202
+    resp.headers["Location"] = url_for("job_status", job_id=job.id)
+    return resp
+
+@app.route("/jobs")
+def list_jobs():
+    return jsonify(jobs.list())
+
+@app.route("/jobs/<job_id>", methods=["GET", "DELETE"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return make_response("Unknown job", 404)
+    if request.method == "DELETE":
+        if job.kind == "regenerate" and not _is_admin():
+            return make_response("Regenerate jobs need the admin token", 403)
+        job.cancel()
+    return jsonify(job.progress())
+
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return make_response("Unknown job", 404)
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    if last_id is not None and not last_id.isdigit():
+        last_id = None
+    resp = Response(stream_events(job, last_id), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"   # nginx: pass events through unbuffered
+    return resp
+
+@app.route("/plans/<plan_hash>")
+def stored_plan(plan_hash):
+    # content-addressed, so a given hash never changes
+    if request.if_none_match.contains(plan_hash):
+        return make_response("", 304)
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        plan = get_plan(conn, plan_hash)
+    finally:
+        conn.close()
+    if plan is None:
+        return make_response("Unknown plan", 404)
+    resp = jsonify(plan)
+    resp.set_etag(plan_hash)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 86400
+    return resp
+
+def session_plan():
+    """
+    Plan dict for the current session, expanding the compact form if needed.
+    The compact form is dressed on expansion; a plain plan saved before
+    base_meals is re-dressed here.
+    """
+    plan = session.get("latest_plan")
+    if isinstance(plan, list):
+        try:
+            return CompactPlan.from_json(plan).expand()
+        except ValueError:
+            return None
+    if plan and "base_meals" not in plan and session.get("latest_profile"):
+        return upgrade_plan(plan, session["latest_profile"])
+    return plan
+
 @app.route("/result")
 def result():
     profile = session.get("latest_profile")
-    plan = session.get("latest_plan")
     plan_source = session.get("plan_source")
-    if not plan or not profile:
+    if not session.get("latest_plan") or not profile:
+        return redirect(url_for("index"))
+
+    # Same plan + profile + template -> same page; answer 304 before rendering
+    etag = content_etag(session["latest_plan"], profile, plan_source, DRESS_VERSION,
+                        template_fingerprint("result.html"))
+    last_modified = session.get("plan_created")
+    if conditional(etag, last_modified):
+        return cache_private(make_response("", 304), etag, last_modified)
+
+    plan = session_plan()
+    if not plan:
         return redirect(url_for("index"))
-    return render_template("result.html", plan=plan, profile=profile, plan_source=plan_source)
+    resp = make_response(render_template("result.html", plan=plan, profile=profile, plan_source=plan_source))
+    return cache_private(resp, etag, last_modified)
+
+MAX_REPORT_WEEKS = 520
+
+@app.route("/reports")
+def reports():
+    # Pre-aggregated counts; only rows added since the last call are scanned
+    weeks = min(max(request.args.get("weeks", 12, type=int), 1), MAX_REPORT_WEEKS)
+    return jsonify(reports_summary(DB_PATH, weeks=weeks))
+
+@app.route("/ready")
+def ready():
+    # 503 until warm_up() has run in this worker (or in the preloading master)
+    return jsonify(WARMUP_STATE), (200 if WARMUP_STATE["ready"] else 503)
+
+@app.route("/admission_stats")
+def admission_stats():
+    return jsonify(admission.stats())
 
 # -------- PDF HELPERS ----------
 def pdf_from_html_weasy(rendered_html: str) -> bytes:
@@ -217,14 +430,17 @@ def pdf_from_reportlab(profile, plan) -> bytes:
     return buf.read()
 
 @app.route("/download_pdf")
+@admission.limit("download_pdf", concurrent=True)
 def download_pdf():
     profile = session.get("latest_profile")
-    plan = session.get("latest_plan")
+    plan = session_plan()
     plan_source = session.get("plan_source")
     if not plan or not profile:
         return redirect(url_for("index"))
 
-    rendered_html = render_template("result.html", plan=plan, profile=profile, plan_source=plan_source)
+    # PDF renderers read the stylesheet from disk rather than over HTTP
+    rendered_html = render_template("result.html", plan=plan, profile=profile, plan_source=plan_source,
+                                    asset_url=asset_file_url)
 
     try:
         if WEASYPRINT_AVAILABLE:
@@ -243,4 +459,5 @@ def download_pdf():
                          download_name="diet_plan.pdf", mimetype="application/pdf")
 
 if __name__ == "__main__":
+    warm_up(app)
     app.run(debug=True)
@@ -0,0 +1,378 @@
+# archive.py
+# -*- coding: utf-8 -*-
+"""
+Tiered storage for old user_cases rows.
+
+  python archive.py archive --days 180 [--db database.db] [--dir archive]
+  python archive.py backfill            # signatures of rows saved before they existed
+  python archive.py get 1234
+  python archive.py find "<signature>"
+
+Cases older than N days are moved out of the hot SQLite file into
+append-only segment files under ARCHIVE_DIR. Each run writes one new
+segment. A segment is JSON lines cut into blocks of BLOCK_ROWS rows, and
+each block is compressed on its own: zstd when the optional `zstandard`
+package is installed, gzip otherwise. `zcat` still reads a whole .gz
+segment, since concatenated gzip members form one stream.
+
+The hot file keeps a small index, one row per archived case:
+
+  archive_index(id -> sig, created_at, segment, block_offset, block_length)
+
+`sig` is a 64-bit hash of the profile signature, so it costs a few bytes
+instead of the ~200-character signature text. A lookup by id therefore
+reads and decompresses a single block. get_case() and find_by_signature()
+check the hot table first and the archive second, so callers don't need
+to know where a case lives. plan_store.load_case_plan() resolves
+archived cases the same way; segments carry each plan inline, and plans
+no hot case uses any more are dropped from the plan store.
+
+Report aggregates are refreshed before rows are moved, so archived cases
+stay counted.
+
+Archived cases are frozen: segments are append-only, and batch
+regeneration (batch.py and the /jobs regenerate job) and
+plan_store.py redress only rewrite hot rows. An archived case keeps the
+plan it had when it was moved, and the batch log says how many cases it
+left alone.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+
+from batch import CASE_COLUMNS, profile_from_row
+from plan_store import get_plan, gc_plans
+from utils import calc_bmi, weight_class_from_bmi, age_band, signature
+
+# Optional zstd support
+ZSTD_AVAILABLE = False
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except Exception:
+    ZSTD_AVAILABLE = False
+
+DB_PATH = Path("database.db")
+ARCHIVE_DIR = Path("archive")
+BLOCK_ROWS = 256          # rows per compressed block (one block is read per lookup)
+SEGMENT_ROWS = 100000     # rows per segment file
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive_segments (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    min_id INTEGER,
+    max_id INTEGER,
+    bytes INTEGER,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS archive_index (
+    id INTEGER PRIMARY KEY,
+    sig INTEGER,
+    created_at TEXT,
+    segment INTEGER NOT NULL,
+    block_offset INTEGER NOT NULL,
+    block_length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_archive_sig ON archive_index(sig);
+"""
+
+
+###############################################################################
+# Signatures
+###############################################################################
+
+def case_signature(profile):
+    """
+    utils.signature() of a stored profile dict (derives age band/weight class).
+    """
+    data = dict(profile)
+    try:
+        bmi = calc_bmi(float(data.get("weight") or 0), float(data.get("height") or 0))
+        band = age_band(int(data.get("age") or 0))
+    except (TypeError, ValueError):
+        bmi, band = 0.0, None
+    data["age_band"] = band
+    data["weight_class"] = weight_class_from_bmi(bmi)
+    allergies = data.get("allergies")
+    if isinstance(allergies, (list, tuple, set)):
+        data["allergies"] = ",".join(sorted(allergies)) or None
+    return signature(data)
+
+
+def _sig_key(sig):
+    # signed 64-bit, fits SQLite INTEGER
+    return int.from_bytes(hashlib.blake2b(sig.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+def init_archive(con):
+    """
+    Archive tables and the user_cases.signature column. Schema only: it runs
+    at app startup, so existing rows are filled by backfill_signatures().
+    """
+    con.executescript(SCHEMA)
+    columns = [row[1] for row in con.execute("PRAGMA table_info(user_cases)")]
+    if "signature" not in columns:
+        con.execute("ALTER TABLE user_cases ADD COLUMN signature TEXT")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_user_cases_signature ON user_cases(signature)")
+
+
+def backfill_signatures(con, batch=1000, log=print):
+    """
+    Fill user_cases.signature for rows saved before the column existed, in
+    id order, one transaction per `batch` rows. Safe to re-run.
+    """
+    columns = [row[1] for row in con.execute("PRAGMA table_info(user_cases)")]
+    names = CASE_COLUMNS + (("profile",) if "profile" in columns else ())
+    select = f"SELECT {', '.join(names)} FROM user_cases WHERE signature IS NULL AND id > ? ORDER BY id LIMIT ?"
+    filled = 0
+    last_id = 0
+    while True:
+        rows = [dict(zip(names, values)) for values in con.execute(select, (last_id, batch)).fetchall()]
+        if not rows:
+            break
+        with con:
+            con.executemany(
+                "UPDATE user_cases SET signature = ? WHERE id = ?",
+                [(case_signature(profile_from_row(row)), row["id"]) for row in rows],
+            )
+        last_id = rows[-1]["id"]
+        filled += len(rows)
+    log(f"backfilled signatures of {filled} cases")
+    return filled
+
+
+###############################################################################
+# Segment blocks
+###############################################################################
+
+def _suffix():
+    return ".jsonl.zst" if ZSTD_AVAILABLE else ".jsonl.gz"
+
+
+def _compress(data):
+    if ZSTD_AVAILABLE:
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return gzip.compress(data, compresslevel=9)
+
+
+def _decompress(path, data):
+    if path.endswith(".zst"):
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError(f"{path} is zstd-compressed; install `zstandard` to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+@lru_cache(maxsize=64)
+def _read_block(path, offset, length):
+    """
+    Raw JSON lines of one block (cached; segments never change).
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return tuple(_decompress(path, data).decode("utf-8").splitlines())
+
+
+def _write_segment(path, rows):
+    """
+    Write rows as compressed blocks; returns [(id, offset, length), ...].
+    Written to a temp file and renamed, so a segment is complete or absent.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    placement = []
+    with open(tmp, "wb") as f:
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start:start + BLOCK_ROWS]
+            data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in block)
+            blob = _compress(data.encode("utf-8"))
+            offset = f.tell()
+            f.write(blob)
+            placement += [(r["id"], offset, len(blob)) for r in block]
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return placement
+
+
+###############################################################################
+# Lookups (hot table first, then archive)
+###############################################################################
+
+def _hot_rows(con, where, params):
+    cur = con.execute(f"SELECT * FROM user_cases WHERE {where}", params)
+    names = [d[0] for d in cur.description]
+    return [dict(zip(names, values)) for values in cur.fetchall()]
+
+
+def _archived(con, where, params):
+    try:
+        entries = con.execute(
+            "SELECT i.id, s.path, i.block_offset, i.block_length FROM archive_index i "
+            f"JOIN archive_segments s ON s.id = i.segment WHERE {where}",
+            params,
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return []   # nothing archived in this database yet
+    out = []
+    for case_id, path, offset, length in entries:
+        for line in _read_block(path, offset, length):
+            # ids are the first key of every record
+            if line.startswith(f'{{"id":{case_id},'):
+                out.append(json.loads(line))
+                break
+    return out
+
+
+def get_case(con, case_id):
+    """
+    user_cases row dict for `case_id`, from the hot table or the archive.
+    """
+    rows = _hot_rows(con, "id = ?", (case_id,))
+    if rows:
+        return rows[0]
+    rows = _archived(con, "i.id = ?", (case_id,))
+    return rows[0] if rows else None
+
+
+def find_by_signature(con, sig, limit=None):
+    """
+    Cases with profile signature `sig`, newest (highest id) first, hot and
+    archived.
+    """
+    rows = _hot_rows(con, "signature = ? ORDER BY id DESC", (sig,))
+    if limit is None or len(rows) < limit:
+        archived = _archived(con, "i.sig = ? ORDER BY i.id DESC", (_sig_key(sig),))
+        rows += [r for r in archived if r.get("signature") == sig]
+        rows.sort(key=lambda r: r["id"], reverse=True)
+    return rows[:limit] if limit is not None else rows
+
+
+###############################################################################
+# Archiving
+###############################################################################
+
+def _db_size(con):
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    return con.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+
+def archive_cases(db_path=DB_PATH, days=180, archive_dir=ARCHIVE_DIR, vacuum=True, log=print):
+    """
+    Move cases created more than `days` ago into a new segment. Returns
+    the number of cases moved.
+    """
+    from reports import refresh   # reports reads the archive for full rebuilds
+
+    con = sqlite3.connect(db_path)
+    init_archive(con)
+    con.commit()
+    backfill_signatures(con, log=log)   # the index keeps each case's signature hash
+    refresh(con)   # fold every row into the aggregates before it leaves
+    before = _db_size(con)
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+
+    moved = 0
+    while True:
+        cur = con.execute(
+            "SELECT * FROM user_cases WHERE created_at < ? ORDER BY id LIMIT ?", (cutoff, SEGMENT_ROWS)
+        )
+        names = [d[0] for d in cur.description]
+        rows = [dict(zip(names, values)) for values in cur.fetchall()]
+        if not rows:
+            break
+        for row in rows:
+            # segments are self-contained: the plan goes inline, so the plan
+            # store only has to keep plans of hot cases
+            if row.get("plan_hash") and not row.get("plan"):
+                plan = get_plan(con, row["plan_hash"])
+                row["plan"] = json.dumps(plan) if plan is not None else None
+
+        path = archive_dir / f"cases-{rows[0]['id']:09d}-{rows[-1]['id']:09d}{_suffix()}"
+        placement = _write_segment(path, rows)
+        try:
+            with con:  # index + delete commit together; on failure the rows stay hot
+                segment = con.execute(
+                    "INSERT INTO archive_segments (path, rows, min_id, max_id, bytes, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (str(path), len(rows), rows[0]["id"], rows[-1]["id"], path.stat().st_size,
+                     datetime.now().isoformat()),
+                ).lastrowid
+                sigs = {r["id"]: (_sig_key(r["signature"]) if r.get("signature") else None, r.get("created_at"))
+                        for r in rows}
+                con.executemany(
+                    "INSERT INTO archive_index (id, sig, created_at, segment, block_offset, block_length) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(case_id, *sigs[case_id], segment, offset, length) for case_id, offset, length in placement],
+                )
+                con.executemany("DELETE FROM user_cases WHERE id = ?", [(r["id"],) for r in rows])
+                gc_plans(con)
+        except Exception:
+            path.unlink(missing_ok=True)
+            raise
+        moved += len(rows)
+        log(f"archived {len(rows)} cases -> {path} ({path.stat().st_size / 1024:.0f} KiB)")
+
+    if vacuum and moved:
+        con.execute("VACUUM")
+    after = _db_size(con)
+    con.close()
+    log(f"moved {moved} cases older than {days} days; db {before / 1024:.0f} KiB -> {after / 1024:.0f} KiB")
+    return moved
+
+
+def iter_archived(con):
+    """
+    Every archived case record, segment by segment (for full report rebuilds).
+    """
+    try:
+        segments = con.execute("SELECT path FROM archive_segments ORDER BY id").fetchall()
+    except sqlite3.OperationalError:
+        return
+    for (path,) in segments:
+        offsets = con.execute(
+            "SELECT DISTINCT i.block_offset, i.block_length FROM archive_index i "
+            "JOIN archive_segments s ON s.id = i.segment WHERE s.path = ? ORDER BY i.block_offset",
+            (path,),
+        ).fetchall()
+        for offset, length in offsets:
+            for line in _read_block(path, offset, length):
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old cases to compressed segment files.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_archive = sub.add_parser("archive", help="archive cases older than --days")
+    p_archive.add_argument("--days", type=int, default=180)
+    p_archive.add_argument("--dir", default=str(ARCHIVE_DIR))
+    p_archive.add_argument("--no-vacuum", action="store_true")
+    sub.add_parser("backfill", help="fill signatures of cases saved before the column existed")
+    sub.add_parser("get", help="print one case by id").add_argument("id", type=int)
+    sub.add_parser("find", help="print cases with a signature").add_argument("signature")
+    for p in sub.choices.values():
+        p.add_argument("--db", default=str(DB_PATH))
+    args = parser.parse_args()
+
+    if args.command == "archive":
+        archive_cases(args.db, args.days, args.dir, vacuum=not args.no_vacuum)
+    elif args.command == "backfill":
+        con = sqlite3.connect(args.db)
+        init_archive(con)
+        con.commit()
+        backfill_signatures(con)
+    else:
+        con = sqlite3.connect(args.db)
+        found = [get_case(con, args.id)] if args.command == "get" else find_by_signature(con, args.signature)
+        for case in found:
+            print(json.dumps(case, ensure_ascii=False, indent=2) if case else "not found")
@@ -0,0 +1,289 @@
+# batch.py
+# -*- coding: utf-8 -*-
+"""
+Regenerate the stored plan of every user_cases row, e.g. after the meal
+library or condition rules change.
+
+  python batch.py --job rules-v2 [--db database.db] [--workers 8] [--chunk 500]
+
+Rows are read in id-range chunks, generated in a process pool (the meal
+library and rules are loaded once per worker by the initializer) and
+written back one transaction per chunk. The last finished id is stored in
+batch_checkpoints inside the same transaction, so re-running the same job
+name resumes where it stopped.
+
+Archived cases (see archive.py) are frozen and not regenerated; the run
+logs how many there are. Only rows with a saved profile JSON are
+regenerated. Older rows have just
+the basic columns, without diet preference, allergies or most
+conditions, so a plan rebuilt from them could serve meat to a vegetarian
+or an allergen to an allergic user; they keep their plan as it is and are
+counted as skipped.
+
+iter_run() yields the (case id, plan hash) pairs of each chunk once it is
+committed, for callers that report progress (the /jobs endpoint).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from plan_store import init_plan_store, put_plan
+
+DB_PATH = Path("database.db")
+PLAN_SOURCE = "Batch regenerated"
+
+# iter_run also runs on a background thread of a threaded gunicorn worker
+# (/jobs); forking that process could copy a lock another thread holds
+# (logging, sqlite) into the pool workers, so they start fresh instead.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batch_checkpoints (
+    job TEXT PRIMARY KEY,
+    last_id INTEGER,
+    done INTEGER,
+    updated_at TEXT
+)
+"""
+
+# Columns every user_cases layout has; `profile` (full JSON) is newer
+CASE_COLUMNS = (
+    "id", "name", "age", "gender", "weight", "height", "sleep",
+    "activity", "stress", "work_type", "bp", "sugar", "thyroid",
+)
+
+# only rows carrying the full profile JSON can be regenerated faithfully
+HAS_PROFILE = "profile IS NOT NULL AND profile != ''"
+
+
+###############################################################################
+# Row -> profile
+###############################################################################
+
+def profile_from_row(row):
+    """
+    Rebuild the generate_plan profile for a stored case. Uses the saved
+    profile JSON when present; older rows only have the basic columns, so
+    the remaining fields fall back to the form defaults. Good enough for
+    signatures and reports; regeneration uses saved_profile().
+    """
+    profile = {
+        "goal": "fitness",
+        "diet_pref": "both",
+        "allergies": [],
+        "pcod": "no",
+        "cholesterol": "normal",
+        "heart": "no",
+        "kidney": "no",
+        "pregnancy": "na",
+    }
+    for key in CASE_COLUMNS[1:]:
+        if row.get(key) is not None:
+            profile[key] = row[key]
+    if row.get("profile"):
+        try:
+            profile.update(json.loads(row["profile"]))
+        except ValueError:
+            pass
+    return profile
+
+
+def saved_profile(row):
+    """
+    The profile JSON saved with a case, or None if the row has none that
+    parses (its plan must then be left alone).
+    """
+    try:
+        profile = json.loads(row.get("profile") or "")
+    except ValueError:
+        return None
+    return profile if isinstance(profile, dict) and profile else None
+
+
+###############################################################################
+# Worker side
+###############################################################################
+
+_generate = None
+
+def _init_worker():
+    """
+    Import the generator (meal library + rules) once per worker process.
+    """
+    global _generate
+    from diet_generator import generate_plan
+    _generate = generate_plan
+
+
+def _regenerate_chunk(rows):
+    """
+    rows: list of row dicts -> list of (plan, id). Seeded by case id so
+    a resumed or repeated run produces the same plans. Rows without a
+    usable profile are left out.
+    """
+    out = []
+    for row in rows:
+        profile = saved_profile(row)
+        if profile is None:
+            continue
+        random.seed(row["id"])
+        plan, _ = _generate(profile)
+        out.append((plan, row["id"]))
+    return out
+
+
+###############################################################################
+# Driver
+###############################################################################
+
+def _connect(db_path):
+    con = sqlite3.connect(db_path)
+    con.row_factory = sqlite3.Row
+    return con
+
+
+def _has_profile_column(con):
+    return any(r["name"] == "profile" for r in con.execute("PRAGMA table_info(user_cases)"))
+
+
+def _read_chunks(con, start_id, max_id, chunk):
+    """
+    Yield (last_id_of_range, rows) for consecutive id ranges after start_id,
+    rows limited to those with a profile.
+    """
+    lo = start_id
+    while lo < max_id:
+        hi = min(lo + chunk, max_id)
+        rows = con.execute(
+            f"SELECT id, profile FROM user_cases WHERE id > ? AND id <= ? AND {HAS_PROFILE} ORDER BY id",
+            (lo, hi),
+        ).fetchall()
+        yield hi, [dict(r) for r in rows]
+        lo = hi
+
+
+def _count_after(con, start_id):
+    """
+    (rows with a profile, rows without) after start_id.
+    """
+    if not _has_profile_column(con):
+        return 0, con.execute("SELECT COUNT(*) FROM user_cases WHERE id > ?", (start_id,)).fetchone()[0]
+    row = con.execute(
+        f"SELECT COUNT(*), COALESCE(SUM({HAS_PROFILE}), 0) FROM user_cases WHERE id > ?", (start_id,)
+    ).fetchone()
+    return row[1], row[0] - row[1]
+
+
+def _count_archived(con):
+    if not con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_index'").fetchone():
+        return 0
+    return con.execute("SELECT COUNT(*) FROM archive_index").fetchone()[0]
+
+
+def count_pending(job, db_path=DB_PATH):
+    """
+    Rows `job` still has to regenerate (rows without a profile don't count).
+    """
+    con = _connect(db_path)
+    con.execute(CHECKPOINT_SCHEMA)
+    cp = con.execute("SELECT last_id FROM batch_checkpoints WHERE job = ?", (job,)).fetchone()
+    total, _ = _count_after(con, cp[0] if cp else 0)
+    con.close()
+    return total
+
+
+def run(job, db_path=DB_PATH, workers=None, chunk=500, log=print):
+    """
+    Regenerate all cases for `job`, resuming from its checkpoint.
+    Returns the number of rows written by this run.
+    """
+    return sum(len(pairs) for pairs in iter_run(job, db_path, workers, chunk, log))
+
+
+def iter_run(job, db_path=DB_PATH, workers=None, chunk=500, log=print):
+    """
+    Generator form of run(): yields [(case_id, plan_hash), ...] per committed
+    chunk. Closing it early leaves the checkpoint at the last committed chunk.
+    """
+    workers = workers or os.cpu_count() or 1
+    con = _connect(db_path)
+    con.execute(CHECKPOINT_SCHEMA)
+    init_plan_store(con)
+    con.commit()
+
+    cp = con.execute("SELECT last_id, done FROM batch_checkpoints WHERE job = ?", (job,)).fetchone()
+    start_id, done_before = (cp["last_id"], cp["done"]) if cp else (0, 0)
+    max_id = con.execute("SELECT COALESCE(MAX(id), 0) FROM user_cases").fetchone()[0]
+    total, skipped = _count_after(con, start_id)
+    if start_id:
+        log(f"[{job}] resuming after id {start_id} ({done_before} rows already done)")
+    if skipped:
+        log(f"[{job}] skipping {skipped} rows without a saved profile; their plans are kept")
+    archived = _count_archived(con)
+    if archived:
+        log(f"[{job}] {archived} archived cases are frozen and not regenerated")
+    if not _has_profile_column(con):
+        con.close()
+        return
+
+    written = 0
+    started = time.perf_counter()
+
+    def write(last_id, results):
+        nonlocal written
+        with con:  # one transaction per chunk, checkpoint included
+            updates = [(put_plan(con, plan), case_id) for plan, case_id in results]
+            con.executemany(
+                f"UPDATE user_cases SET plan_hash = ?, plan = NULL, plan_source = '{PLAN_SOURCE}' WHERE id = ?",
+                updates,
+            )
+            con.execute(
+                "INSERT OR REPLACE INTO batch_checkpoints (job, last_id, done, updated_at) VALUES (?, ?, ?, ?)",
+                (job, last_id, done_before + written + len(results), datetime.now().isoformat()),
+            )
+        written += len(results)
+        elapsed = time.perf_counter() - started
+        rate = written / elapsed if elapsed else 0.0
+        eta = (total - written) / rate if rate else 0.0
+        log(f"[{job}] {written}/{total} rows  {rate:.0f} rows/s  eta {eta:.0f}s  (id <= {last_id})")
+        return [(case_id, plan_hash) for plan_hash, case_id in updates]
+
+    # Results are written in id order so the checkpoint only ever moves forward;
+    # a bounded window of in-flight chunks keeps every worker busy meanwhile.
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               mp_context=multiprocessing.get_context(START_METHOD))
+    pending = deque()
+    try:
+        for last_id, rows in _read_chunks(con, start_id, max_id, chunk):
+            pending.append((last_id, pool.submit(_regenerate_chunk, rows)))
+            if len(pending) >= workers * 2:
+                last, fut = pending.popleft()
+                yield write(last, fut.result())
+        while pending:
+            last, fut = pending.popleft()
+            yield write(last, fut.result())
+    finally:
+        # closed early: chunks still queued are dropped, not written
+        pool.shutdown(cancel_futures=True)
+        con.close()
+
+    elapsed = time.perf_counter() - started
+    log(f"[{job}] done: {written} rows in {elapsed:.1f}s with {workers} workers")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate plans for all stored user cases.")
+    parser.add_argument("--job", required=True, help="checkpoint name; reuse it to resume")
+    parser.add_argument("--db", default=str(DB_PATH))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk", type=int, default=500, help="ids per chunk / transaction")
+    args = parser.parse_args()
+    run(args.job, Path(args.db), args.workers, args.chunk)
@@ -0,0 +1,545 @@
+# check_generator.py
+# -*- coding: utf-8 -*-
+"""
+Property checks + performance gates for the plan generator.
+
+  python check_generator.py [--cases 3000] [--seed 0] [--exhaustive]
+                            [--no-perf] [--no-hashseed] [--budget-scale 1.5]
+                            [--update-golden]
+
+Profiles are drawn at random (fixed seed) from goals x diet preferences x
+all 64 condition combinations x allergy lists. The allergy lists mix
+common allergens, words taken from the meal library and random
+fragments. --exhaustive also walks every goal/preference/condition
+combination once. For every profile:
+
+  invariants   7 days x 4 slots, all filled; no allergen in any meal
+               unless the slot fell back to FALLBACK_MEALS; a meal still
+               mentioning an avoided token (not "no sugar"-style
+               qualified) is annotated "(modified)"
+  equivalence  under the same seed the meal grid equals reference_grid(),
+               a plain restatement of the rules; a validated Profile gives
+               the same plan as the dict path; compact round trip,
+               regenerate() with unchanged input and a one-member group
+               reproduce generate_plan; regenerate() after adding an
+               allergen still satisfies the invariants and keeps every
+               base meal that doesn't contain it
+
+reference_grid() follows the current rules, so it can't notice them
+drifting. fixtures/golden_plans.json holds fixed grids from the generator
+before whole-word avoid/swap matching, each with its deliberate
+differences ("changed": day -> slot -> text). Today's generator must give
+exactly the golden grid with those differences applied, and upgrade_plan()
+must turn the golden grid into the same thing. A generator change that is
+meant to alter plans is recorded with --update-golden (and DRESS_VERSION
+bumped); the fixture diff then lists every text it changed.
+
+A few hundred profiles are then generated again in subprocesses under
+different PYTHONHASHSEED values. The plan-store hashes must match, so
+every worker stores identical plans under one hash.
+
+Then each hot path is timed and compared with PERF_BUDGETS (microseconds
+per call, on the reference box). Use --budget-scale on slower hardware.
+Exits 1 on any failure, so it can gate CI or a deploy.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from diet_generator import (
+    generate_plan, regenerate, generate_group_plan, member_diet_plan, upgrade_plan,
+    _pick_week, _profile_context,
+    SLOTS, MEAL_LIBRARY, FALLBACK_MEALS, CONDITION_RULES,
+)
+from compact_plan import CompactPlan, compact_plan
+from plan_store import _canonical
+from profile_schema import parse_form
+
+GOALS = ("fitness", "weight_loss", "weight_gain", "muscle")
+PREFS = ("veg", "nonveg", "vegan", "both", "Non-Veg", "Vegan")
+# form field + value switching on each of the six conditions
+COND_FIELDS = (
+    ("sugar", "diabetic"),
+    ("bp", "high"),
+    ("thyroid", "hypo"),
+    ("kidney", "yes"),
+    ("pcod", "yes"),
+    ("pregnancy", "yes"),
+)
+COMMON_ALLERGENS = (
+    "peanut", "egg", "milk", "lactose", "gluten", "wheat", "soy", "fish",
+    "prawn", "nuts", "sesame", "curd", "paneer", "oats", "dal",
+)
+
+# microseconds per call, about twice the best of several runs on a
+# single-core reference box (timings there vary by up to ~1.6x)
+PERF_BUDGETS = {
+    "generate_plan(dict)": 500,
+    "generate_plan(Profile)": 500,
+    "regenerate(+allergy)": 300,
+    "CompactPlan.expand": 40,
+    "generate_group_plan(10)": 450,
+}
+
+
+###############################################################################
+# Inputs
+###############################################################################
+
+def _library_words():
+    words = set()
+    for bank in MEAL_LIBRARY.values():
+        for items in bank.values():
+            for item in items:
+                words.update(w.strip("()+,/").lower() for w in item.split())
+    return sorted(w for w in words if len(w) > 2)
+
+
+def random_allergies(rng, words):
+    allergies = []
+    for _ in range(rng.choice((0, 0, 1, 1, 2, 3))):
+        kind = rng.random()
+        if kind < 0.4:
+            allergies.append(rng.choice(COMMON_ALLERGENS))
+        elif kind < 0.8:
+            allergies.append(rng.choice(words))
+        else:
+            word = rng.choice(words)
+            start = rng.randrange(len(word))
+            allergies.append(word[start:start + rng.randint(2, 4)])
+    return allergies
+
+
+def make_profile(goal, pref, conds, allergies, weight=70):
+    profile = {
+        "name": "check", "age": 35, "weight": weight, "height": 170, "sleep": 7,
+        "goal": goal, "diet_pref": pref, "allergies": allergies,
+        "stress": "high" if "kidney" in conds else "low",
+    }
+    for field, value in conds:
+        profile[field] = value
+    return profile
+
+
+def random_profiles(n, seed):
+    rng = random.Random(seed)
+    words = _library_words()
+    for _ in range(n):
+        conds = [c for c in COND_FIELDS if rng.random() < 0.3]
+        yield make_profile(rng.choice(GOALS), rng.choice(PREFS), conds,
+                           random_allergies(rng, words), weight=rng.choice((45, 70, 95)))
+
+
+def exhaustive_profiles():
+    for goal, pref in itertools.product(GOALS, PREFS[:4]):
+        for mask in range(1 << len(COND_FIELDS)):
+            conds = [c for i, c in enumerate(COND_FIELDS) if mask >> i & 1]
+            yield make_profile(goal, pref, conds, [])
+
+
+###############################################################################
+# Reference implementation of the meal grid
+###############################################################################
+
+QUALIFIERS = ("no ", "low ", "added ", "avoid ")
+ANNOTATIONS = (" (modified)", " (controlled portion)", " (generous portion)")
+
+
+def _is_word(text, i):
+    return 0 <= i < len(text) and (text[i].isalnum() or text[i] == "_")
+
+
+def _mention_at(text, i, token):
+    """
+    True if `token` is mentioned at text[i]: same letters (any case), word
+    boundaries on both sides, not preceded by a qualifier like "no ".
+    """
+    end = i + len(token)
+    if text[i:end].lower() != token.lower():
+        return False
+    if _is_word(text, i - 1) == _is_word(text, i) or _is_word(text, end - 1) == _is_word(text, end):
+        return False
+    return not text[:i].lower().endswith(QUALIFIERS)
+
+
+def mentioned(token, text):
+    if not token:
+        return False
+    lowered, token_l = text.lower(), token.lower()
+    i = lowered.find(token_l)
+    while i != -1:
+        if _mention_at(text, i, token):
+            return True
+        i = lowered.find(token_l, i + 1)
+    return False
+
+
+def reference_apply(text, avoids, swaps):
+    """
+    _apply_avoids_and_swaps written as a plain left-to-right scan.
+    """
+    if not any(mentioned(bad, text) for bad in avoids):
+        return text
+    sources = sorted(swaps, key=len, reverse=True)
+    out = []
+    i = 0
+    while i < len(text):
+        src = next((s for s in sources if _mention_at(text, i, s)), None)
+        if src is None:
+            out.append(text[i])
+            i += 1
+            continue
+        dst = swaps[src]
+        if text[i].isupper() and dst[:1].islower():
+            dst = dst[:1].upper() + dst[1:]
+        out.append(dst)
+        i += len(src)
+    modified = "".join(out)
+    if any(mentioned(bad, modified) for bad in avoids) and "(modified" not in modified.lower():
+        modified += " (modified)"
+    return modified.replace("  ", " ").strip()
+
+def reference_grid(profile):
+    """
+    The meal rules written out directly: bank for the preference minus
+    allergen items (fallback if empty), 7 picks per slot in slot order,
+    each dressed with the merged condition avoids/swaps plus goal swaps,
+    portion note on main meals. Must match generate_plan under one seed.
+    """
+    ctx = _profile_context(profile)
+    pref, goal = ctx["diet_pref"], ctx["goal"]
+    keys = (pref,) if pref in ("veg", "nonveg", "vegan") else ("veg", "nonveg", "vegan")
+    bank = {}
+    for slot in SLOTS:
+        items = list(dict.fromkeys(i for k in keys for i in MEAL_LIBRARY[k][slot]))
+        items = [i for i in items if not any(a in i.lower() for a in ctx["allergies"])]
+        bank[slot] = items or [FALLBACK_MEALS[slot]]
+
+    avoids, swaps = set(), {}
+    for key in ctx["active_conditions"]:
+        avoids.update(a.lower() for a in CONDITION_RULES[key].get("avoid", []))
+        swaps.update(CONDITION_RULES[key].get("swaps") or {})
+    goal_swaps = {
+        "weight_loss": {"fried": "grilled", "biryani": "small portion pulao (low oil)",
+                        "paratha": "roti (low oil)"},
+        "weight_gain": {"low oil": "moderate oil", "no added sugar": "honey (small)"},
+    }.get(goal, {})
+    for src, dst in goal_swaps.items():
+        swaps.setdefault(src, dst)
+    swaps = {s: d for s, d in swaps.items() if not any(a in d.lower() for a in ctx["allergies"])}
+
+    wc = ctx["weight_class"]
+    if goal == "weight_loss" or wc in ("Overweight", "Obese"):
+        portion = " (controlled portion)"
+    elif goal == "weight_gain" or wc == "Underweight":
+        portion = " (generous portion)"
+    else:
+        portion = ""
+
+    week = {slot: _pick_week(bank[slot], 7) for slot in SLOTS}
+    return {
+        f"Day {i + 1}": {
+            slot: reference_apply(week[slot][i], avoids, swaps) + ("" if slot == "snack" else portion)
+            for slot in SLOTS
+        }
+        for i in range(7)
+    }
+
+
+###############################################################################
+# Properties
+###############################################################################
+
+def check_invariants(profile, diet_plan):
+    """
+    Problems (strings) with one diet grid; empty when it is fine.
+    """
+    ctx = _profile_context(profile)
+    avoids = set()
+    for key in ctx["active_conditions"]:
+        avoids.update(a.lower() for a in CONDITION_RULES[key].get("avoid", []))
+
+    problems = []
+    if list(diet_plan) != [f"Day {i + 1}" for i in range(7)]:
+        problems.append(f"days {list(diet_plan)}")
+    for day, meals in diet_plan.items():
+        for slot in SLOTS:
+            text = meals.get(slot)
+            if not isinstance(text, str) or not text.strip():
+                problems.append(f"{day} {slot}: empty")
+                continue
+            meal = text
+            for note in ANNOTATIONS:
+                meal = meal.replace(note, "")
+            lowered = meal.lower()
+            fallback = lowered.startswith(FALLBACK_MEALS[slot].lower())
+            for allergen in ctx["allergies"]:
+                if allergen in lowered and not fallback:
+                    problems.append(f"{day} {slot}: allergen {allergen!r} in {text!r}")
+            if "(modified)" not in text:
+                for bad in avoids:
+                    if mentioned(bad, meal):
+                        problems.append(f"{day} {slot}: avoided {bad!r} unannotated in {text!r}")
+    return problems
+
+
+def check_profile(profile, seed):
+    problems = []
+
+    random.seed(seed)
+    plan, prof = generate_plan(profile)
+    problems += check_invariants(profile, plan["diet_plan"])
+
+    random.seed(seed)
+    if reference_grid(profile) != plan["diet_plan"]:
+        problems.append("diet grid differs from reference_grid")
+
+    form = dict(profile, allergies=",".join(profile["allergies"]))
+    random.seed(seed)
+    schema_plan, _ = generate_plan(parse_form(form))
+    random.seed(seed)
+    dict_plan, _ = generate_plan(parse_form(form).to_dict())
+    if schema_plan != dict_plan:
+        problems.append("Profile path differs from dict path")
+
+    # None: an allergen dropped a swap the dress code can't express; the
+    # plan is then kept as a plain dict, picks included
+    compact = compact_plan(plan, prof)
+    if compact is not None and CompactPlan.from_bytes(compact.to_bytes()).expand() != plan:
+        problems.append("compact round trip differs")
+
+    if regenerate(plan, profile, profile)[0] != plan:
+        problems.append("regenerate(unchanged) differs")
+
+    random.seed(seed)
+    group, _ = generate_group_plan([profile])
+    if member_diet_plan(group, 0) != plan["diet_plan"]:
+        problems.append("one-member group grid differs")
+    if group["members"][0]["notes"] != plan["notes"]:
+        problems.append("one-member group notes differ")
+
+    more = dict(profile, allergies=profile["allergies"] + [random.Random(seed).choice(COMMON_ALLERGENS)])
+    updated, _ = regenerate(plan, profile, more)
+    problems += [f"regenerate(+allergy): {p}" for p in check_invariants(more, updated["diet_plan"])]
+    added = more["allergies"][-1].lower()
+    rerolled = sum(
+        1 for slot, items in plan["base_meals"].items() for d, item in enumerate(items)
+        if added not in item.lower() and updated["base_meals"][slot][d] != item
+    )
+    if rerolled:
+        problems.append(f"regenerate(+allergy) re-rolled {rerolled} safe slot(s)")
+    return problems
+
+
+def run_properties(profiles, seed, log=print):
+    failures = 0
+    checked = 0
+    for i, profile in enumerate(profiles):
+        problems = check_profile(profile, seed + i)
+        checked += 1
+        if problems:
+            failures += 1
+            if failures <= 10:
+                log(f"FAIL seed={seed + i} profile={profile}")
+                for p in problems[:5]:
+                    log(f"    {p}")
+    log(f"properties: {checked} profiles, {failures} failing")
+    return failures
+
+
+###############################################################################
+# Hash-seed stability
+###############################################################################
+
+HASH_SEEDS = ("0", "1", "2", "3")
+
+
+def plans_digest(n, seed):
+    """
+    One digest over the canonical JSON (what put_plan hashes) of n seeded
+    plans, their regenerated and group variants, and the stored profiles.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    profiles = list(random_profiles(n, seed))
+    for i, profile in enumerate(profiles):
+        random.seed(seed + i)
+        plan, prof = generate_plan(profile)
+        more = dict(profile, allergies=profile["allergies"] + ["egg"])
+        updated, updated_prof = regenerate(plan, profile, more)
+        for value in (plan, prof, updated, updated_prof):
+            h.update(_canonical(value).encode("utf-8"))
+    random.seed(seed)
+    group, _ = generate_group_plan(profiles[:20])
+    h.update(_canonical(group).encode("utf-8"))
+    return h.hexdigest()
+
+
+def run_hash_stability(n, seed, log=print):
+    """
+    plans_digest() in one subprocess per HASH_SEEDS value; all must agree.
+    """
+    digests = {}
+    for hash_seed in HASH_SEEDS:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--digest", str(n), "--seed", str(seed)],
+            env=dict(os.environ, PYTHONHASHSEED=hash_seed), cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        )
+        digests[hash_seed] = out.stdout.strip()
+    ok = len(set(digests.values())) == 1
+    if not ok:
+        log(f"FAIL plans differ across PYTHONHASHSEED: {digests}")
+    log(f"hash seeds: {n} profiles x {len(HASH_SEEDS)} seeds, {'stable' if ok else 'UNSTABLE'}")
+    return not ok
+
+
+###############################################################################
+# Golden plans
+###############################################################################
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "golden_plans.json")
+
+
+def _expected_grid(case):
+    grid = {day: dict(row) for day, row in case["diet_plan"].items()}
+    for day, row in case["changed"].items():
+        grid[day].update(row)
+    return grid
+
+
+def run_golden(path=GOLDEN_PATH, update=False, log=print):
+    """
+    Every golden case, with its recorded differences, must come out of
+    today's generate_plan() and of upgrade_plan() on the golden grid.
+    With update=True the differences are re-recorded instead.
+    """
+    with open(path, encoding="utf-8") as f:
+        golden = json.load(f)
+    state = random.getstate()
+    failures = 0
+    for case in golden["cases"]:
+        random.seed(case["seed"])
+        plan, profile = generate_plan(dict(case["profile"]))
+        if update:
+            case["changed"] = {}
+            for day, row in case["diet_plan"].items():
+                for slot, text in row.items():
+                    if plan["diet_plan"][day][slot] != text:
+                        case["changed"].setdefault(day, {})[slot] = plan["diet_plan"][day][slot]
+            continue
+        expected = _expected_grid(case)
+        problems = [f"{day} {slot}: {plan['diet_plan'][day][slot]!r}, golden {text!r}"
+                    for day, row in expected.items() for slot, text in row.items()
+                    if plan["diet_plan"][day][slot] != text]
+        if upgrade_plan({"diet_plan": case["diet_plan"]}, profile)["diet_plan"] != expected:
+            problems.append("upgrade_plan(golden) differs")
+        if problems:
+            failures += 1
+            if failures <= 10:
+                log(f"FAIL golden seed={case['seed']}")
+                for p in problems[:5]:
+                    log(f"    {p}")
+    random.setstate(state)
+    if update:
+        with open(path, "w", encoding="utf-8", newline="\n") as f:
+            json.dump(golden, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+        log(f"golden: {len(golden['cases'])} cases re-recorded")
+        return 0
+    log(f"golden: {len(golden['cases'])} cases, {failures} differing")
+    return failures
+
+
+###############################################################################
+# Performance gates
+###############################################################################
+
+def _per_call_us(fn, min_time=0.3):
+    """
+    Best-of-3 microseconds per call, each round at least `min_time` seconds.
+    """
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        n *= 4
+    n = max(1, int(n * (min_time / 10) / elapsed * 10))
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        best = min(best, (time.perf_counter() - start) / n)
+    return best * 1e6
+
+
+def run_perf(scale=1.0, log=print):
+    profile = make_profile("weight_loss", "both", [COND_FIELDS[0], COND_FIELDS[1]], ["peanut"], weight=95)
+    schema = parse_form(dict(profile, allergies="peanut"))
+    plan, prof = generate_plan(profile)
+    compact = CompactPlan.from_plan(plan, prof)
+    more = dict(profile, allergies=["peanut", "egg"])
+    group = [make_profile(g, p, [], []) for g, p in zip(GOALS * 3, PREFS[:4] * 3)][:10]
+
+    cases = {
+        "generate_plan(dict)": lambda: generate_plan(profile),
+        "generate_plan(Profile)": lambda: generate_plan(schema),
+        "regenerate(+allergy)": lambda: regenerate(plan, profile, more),
+        "CompactPlan.expand": compact.expand,
+        "generate_group_plan(10)": lambda: generate_group_plan(group),
+    }
+    state = random.getstate()
+    failures = 0
+    for name, fn in cases.items():
+        us = _per_call_us(fn)
+        budget = PERF_BUDGETS[name] * scale
+        ok = us <= budget
+        failures += not ok
+        log(f"  {name:<26} {us:8.1f} us  (budget {budget:.0f} us){'' if ok else '  OVER BUDGET'}")
+    random.setstate(state)
+    log(f"perf: {len(cases)} gates, {failures} over budget")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Property checks and perf gates for generate_plan.")
+    parser.add_argument("--cases", type=int, default=3000, help="random profiles to check")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--exhaustive", action="store_true",
+                        help="also check every goal x preference x condition combination")
+    parser.add_argument("--no-perf", action="store_true")
+    parser.add_argument("--no-hashseed", action="store_true", help="skip the PYTHONHASHSEED stability check")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="record today's plans as the golden differences and exit")
+    parser.add_argument("--digest", type=int, metavar="N", help=argparse.SUPPRESS)
+    parser.add_argument("--budget-scale", type=float, default=1.0,
+                        help="multiply every perf budget (slower machines)")
+    args = parser.parse_args()
+
+    if args.digest is not None:
+        # child of run_hash_stability
+        print(plans_digest(args.digest, args.seed))
+        sys.exit(0)
+    if args.update_golden:
+        sys.exit(run_golden(update=True))
+
+    profiles = random_profiles(args.cases, args.seed)
+    if args.exhaustive:
+        profiles = itertools.chain(exhaustive_profiles(), profiles)
+    failed = run_properties(profiles, args.seed)
+    failed += run_golden()
+    if not args.no_hashseed:
+        failed += run_hash_stability(300, args.seed)
+    if not args.no_perf:
+        failed += run_perf(args.budget_scale)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,343 @@
+# compact_plan.py
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory / on-the-wire form of a generated plan.
+
+A plan dict repeats long strings everywhere (meal texts with portion notes,
+notes, exercise lines). CompactPlan keeps only small integers:
+
+  - meals:    7 x 4 ids into MEAL_VOCAB (bank items before swaps/portions)
+  - dress:    condition bitmask + goal swap code -> avoids/swaps to re-apply
+  - portion:  0 none, 1 controlled, 2 generous
+  - notes / exercise: ids into TEXT_VOCAB
+
+Meal ids come straight from the plan's "base_meals" (the generator's
+picks). Plans saved before those were recorded are mapped back from their
+texts; texts that cannot be mapped (legacy or hand-edited plans) are kept
+verbatim in `extra` and referenced by id >= len(MEAL_VOCAB) / len(TEXT_VOCAB).
+expand() rebuilds the usual {"diet_plan", "exercise_plan", "notes",
+"base_meals"} dict and should only be called at the render edge.
+"""
+import json
+import struct
+import zlib
+from functools import lru_cache
+
+from diet_generator import (
+    MEAL_LIBRARY, FALLBACK_MEALS, SLOTS,
+    _profile_context, _avoids_and_swaps, _portion_note, _dress_meal,
+    _build_notes, _build_exercise,
+)
+
+FORMAT_VERSION = 1
+DAYS = tuple(f"Day {i+1}" for i in range(7))
+COND_KEYS = ("diabetes", "bp_or_heart", "thyroid", "kidney", "pcod", "pregnancy")
+PORTIONS = ("", " (controlled portion)", " (generous portion)")
+# goals that add their own swaps (everything else keeps defaults)
+SWAP_GOALS = ("fitness", "weight_loss", "weight_gain")
+
+# kb_snapshot.SharedSnapshot once kb_snapshot.activate() has run: dressed
+# texts then come from the shared mapped file instead of the caches below
+SNAPSHOT = None
+
+
+###############################################################################
+# Vocabularies (sorted so ids are stable for a given rule set)
+###############################################################################
+
+def _meal_vocab():
+    items = set(FALLBACK_MEALS.values())
+    for bank in MEAL_LIBRARY.values():
+        for slot in SLOTS:
+            items.update(bank[slot])
+    return tuple(sorted(items))
+
+
+def _text_vocab():
+    """
+    Every note/exercise line the generator can emit: each line depends on one
+    input at a time, so all conditions on x each weight class/goal/stress
+    covers them.
+    """
+    texts = set()
+    cond = {key: True for key in COND_KEYS}
+    for weight_class in ("Underweight", "Normal", "Overweight", "Obese"):
+        for goal in ("fitness", "weight_loss", "weight_gain", "muscle"):
+            for stress in ("low", "high"):
+                ctx = {
+                    "weight_class": weight_class, "goal": goal, "stress": stress,
+                    "cond": cond, "active_conditions": COND_KEYS,
+                }
+                texts.update(_build_notes(ctx))
+                texts.update(_build_exercise(ctx))
+    return tuple(sorted(texts))
+
+
+MEAL_VOCAB = _meal_vocab()
+TEXT_VOCAB = _text_vocab()
+TEXT_ID = {text: i for i, text in enumerate(TEXT_VOCAB)}
+MEAL_ID = {item: i for i, item in enumerate(MEAL_VOCAB)}
+# Blobs built against a different rule set must not be decoded silently
+VOCAB_CRC = zlib.crc32("\n".join(MEAL_VOCAB + ("",) + TEXT_VOCAB).encode("utf-8"))
+
+_HEADER = struct.Struct("<2sBIBBBBB")  # magic, version, crc, dress, portion, n_notes, n_ex, n_extra
+_MEALS = struct.Struct("<28H")
+
+
+@lru_cache(maxsize=None)
+def _dress_rules(dress):
+    """
+    (avoids, swaps) for a dress code, rebuilt the same way generate_plan does.
+    """
+    ctx = {
+        "active_conditions": tuple(key for i, key in enumerate(COND_KEYS) if dress & (1 << i)),
+        "goal": SWAP_GOALS[dress >> 6],
+    }
+    return _avoids_and_swaps(ctx)
+
+
+def _dress_code(ctx):
+    mask = 0
+    for i, key in enumerate(COND_KEYS):
+        if key in ctx["active_conditions"]:
+            mask |= 1 << i
+    goal = ctx["goal"] if ctx["goal"] in SWAP_GOALS else "fitness"
+    return mask | (SWAP_GOALS.index(goal) << 6)
+
+
+###############################################################################
+# CompactPlan
+###############################################################################
+
+class CompactPlan:
+    __slots__ = ("meals", "dress", "portion", "notes", "exercise", "extra")
+
+    def __init__(self, meals, dress, portion, notes, exercise, extra=()):
+        self.meals = tuple(meals)        # 28 ids, day-major (Day 1 breakfast..dinner, Day 2 ...)
+        self.dress = dress
+        self.portion = portion
+        self.notes = tuple(notes)
+        self.exercise = tuple(exercise)
+        self.extra = tuple(extra)
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactPlan):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    # ----------------- dict <-> compact -------------------
+    @classmethod
+    def from_plan(cls, plan, profile):
+        """
+        Compact a plan dict produced by generate_plan/regenerate for `profile`.
+        Raises ValueError if the plan is not a 7-day, 4-slot plan.
+        """
+        diet_plan = plan.get("diet_plan") or {}
+        if tuple(diet_plan.keys()) != DAYS:
+            raise ValueError("CompactPlan needs a 'Day 1'..'Day 7' diet plan")
+
+        ctx = _profile_context(profile)
+        dress = _dress_code(ctx)
+        portion = PORTIONS.index(_portion_note(ctx))
+
+        extra = []
+        extra_id = {}
+
+        def intern(text, vocab_len):
+            if text not in extra_id:
+                extra_id[text] = len(extra)
+                extra.append(text)
+            return vocab_len + extra_id[text]
+
+        kb = SNAPSHOT.current() if SNAPSHOT is not None else None
+        stored = plan.get("base_meals")
+        if stored is not None and not (
+                isinstance(stored, dict) and all(len(stored.get(slot) or ()) == len(DAYS) for slot in SLOTS)):
+            raise ValueError("CompactPlan: base_meals must list 7 picks per slot")
+        lookup = None if kb or stored else [_dressed_lookup(slot, dress, portion) for slot in SLOTS]
+        suffix = PORTIONS[portion]
+        meals = []
+        for d, day in enumerate(DAYS):
+            row = diet_plan[day]
+            for s, slot in enumerate(SLOTS):
+                text = row.get(slot)
+                if text is None:
+                    raise ValueError(f"CompactPlan: {day} has no {slot}")
+                if stored is not None:
+                    # the recorded pick; the text must be what it renders to
+                    item_id = MEAL_ID.get(stored[slot][d])
+                    if item_id is None or _slot_text(kb, slot, item_id, dress, portion) != text:
+                        raise ValueError(f"CompactPlan: {day} {slot} does not match its base meal")
+                elif kb is None:
+                    item_id = lookup[s].get(text)
+                elif slot == "snack" or not suffix:
+                    item_id = kb.find(dress, text)
+                elif text.endswith(suffix):
+                    item_id = kb.find(dress, text[:-len(suffix)])
+                else:
+                    item_id = None
+                meals.append(item_id if item_id is not None else intern(text, len(MEAL_VOCAB)))
+
+        def text_ids(lines):
+            return [TEXT_ID[t] if t in TEXT_ID else intern(t, len(TEXT_VOCAB)) for t in lines]
+
+        notes = text_ids(plan.get("notes") or [])
+        exercise = text_ids(plan.get("exercise_plan") or [])
+        return cls(meals, dress, portion, notes, exercise, extra)
+
+    def expand(self):
+        """
+        Rebuild the plan dict the templates and PDF helpers consume.
+        """
+        n_meals = len(MEAL_VOCAB)
+        n_text = len(TEXT_VOCAB)
+        kb = SNAPSHOT.current() if SNAPSHOT is not None else None
+
+        diet_plan = {}
+        for d, day in enumerate(DAYS):
+            row = {}
+            for s, slot in enumerate(SLOTS):
+                item_id = self.meals[d * 4 + s]
+                if item_id < n_meals:
+                    row[slot] = _slot_text(kb, slot, item_id, self.dress, self.portion)
+                else:
+                    row[slot] = self.extra[item_id - n_meals]
+            diet_plan[day] = row
+
+        def texts(ids):
+            return [TEXT_VOCAB[i] if i < n_text else self.extra[i - n_text] for i in ids]
+
+        plan = {
+            "diet_plan": diet_plan,
+            "exercise_plan": texts(self.exercise),
+            "notes": texts(self.notes),
+        }
+        if all(item_id < n_meals for item_id in self.meals):
+            # picks are known for every slot, so regenerate() needs no lookup
+            plan["base_meals"] = {
+                slot: [MEAL_VOCAB[self.meals[d * 4 + s]] for d in range(len(DAYS))]
+                for s, slot in enumerate(SLOTS)
+            }
+        return plan
+
+    # ----------------- binary -------------------
+    def to_bytes(self):
+        out = [
+            _HEADER.pack(b"DP", FORMAT_VERSION, VOCAB_CRC, self.dress, self.portion,
+                         len(self.notes), len(self.exercise), len(self.extra)),
+            _MEALS.pack(*self.meals),
+            struct.pack(f"<{len(self.notes) + len(self.exercise)}H", *(self.notes + self.exercise)),
+        ]
+        for text in self.extra:
+            raw = text.encode("utf-8")
+            out.append(struct.pack("<H", len(raw)))
+            out.append(raw)
+        return b"".join(out)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        magic, version, crc, dress, portion, n_notes, n_ex, n_extra = _HEADER.unpack_from(blob, 0)
+        if magic != b"DP" or version != FORMAT_VERSION:
+            raise ValueError("Not a compact plan blob")
+        if crc != VOCAB_CRC:
+            raise ValueError("Compact plan was built against a different meal/rule set")
+        offset = _HEADER.size
+        meals = _MEALS.unpack_from(blob, offset)
+        offset += _MEALS.size
+        ids = struct.unpack_from(f"<{n_notes + n_ex}H", blob, offset)
+        offset += 2 * (n_notes + n_ex)
+        extra = []
+        for _ in range(n_extra):
+            (size,) = struct.unpack_from("<H", blob, offset)
+            offset += 2
+            extra.append(blob[offset:offset + size].decode("utf-8"))
+            offset += size
+        return cls(meals, dress, portion, ids[:n_notes], ids[n_notes:], extra)
+
+    # ----------------- JSON (session / API) -------------------
+    def to_json(self):
+        """
+        Plain JSON-able list: [version, crc, dress, portion, meals, notes, exercise, extra].
+        """
+        return [FORMAT_VERSION, VOCAB_CRC, self.dress, self.portion,
+                list(self.meals), list(self.notes), list(self.exercise), list(self.extra)]
+
+    @classmethod
+    def from_json(cls, data):
+        if isinstance(data, str):
+            data = json.loads(data)
+        version, crc, dress, portion, meals, notes, exercise, extra = data
+        if version != FORMAT_VERSION or crc != VOCAB_CRC:
+            raise ValueError("Compact plan was built against a different meal/rule set")
+        return cls(meals, dress, portion, notes, exercise, extra)
+
+
+def _slot_text(kb, slot, item_id, dress, portion):
+    """
+    Rendered text of bank item `item_id`, from the snapshot `kb` if mapped.
+    """
+    if kb is None:
+        return _dressed_text(slot, item_id, dress, portion)
+    text = kb.dressed(dress, item_id)
+    return text if slot == "snack" else text + PORTIONS[portion]
+
+
+@lru_cache(maxsize=8192)
+def _dressed_text(slot, item_id, dress, portion):
+    avoids, swaps = _dress_rules(dress)
+    return _dress_meal(slot, MEAL_VOCAB[item_id], avoids, swaps, PORTIONS[portion])
+
+
+@lru_cache(maxsize=256)
+def _dressed_lookup(slot, dress, portion):
+    """
+    {rendered slot text: meal id} for one slot under one dress/portion.
+    """
+    return {_dressed_text(slot, i, dress, portion): i for i in range(len(MEAL_VOCAB))}
+
+
+def compact_plan(plan, profile):
+    """
+    Compact `plan` if possible; returns None for plans CompactPlan cannot hold.
+    """
+    try:
+        return CompactPlan.from_plan(plan, profile)
+    except ValueError:
+        return None
+
+
+###############################################################################
+# Size / speed comparison against the plain JSON form
+###############################################################################
+if __name__ == "__main__":
+    import random
+    from timeit import timeit
+    from diet_generator import generate_plan
+
+    random.seed(7)
+    sample_profile = {
+        "weight": 78, "height": 164, "stress": "high", "goal": "weight_loss",
+        "diet_pref": "Both", "allergies": ["lactose"], "bp": "high",
+        "sugar": "prediabetic", "thyroid": "hypo", "pcod": "yes",
+    }
+    plan, prof = generate_plan(sample_profile)
+    cp = CompactPlan.from_plan(plan, prof)
+    assert cp.expand() == plan
+    assert CompactPlan.from_bytes(cp.to_bytes()) == cp
+    assert CompactPlan.from_json(json.dumps(cp.to_json())) == cp
+
+    as_json = json.dumps(plan)
+    as_compact_json = json.dumps(cp.to_json())
+    as_bytes = cp.to_bytes()
+    n = 20000
+    print(f"plain JSON      : {len(as_json.encode('utf-8')):5d} bytes")
+    print(f"compact JSON    : {len(as_compact_json):5d} bytes")
+    print(f"compact binary  : {len(as_bytes):5d} bytes")
+    print(f"json.dumps(plan)        {timeit(lambda: json.dumps(plan), number=n) / n * 1e6:7.2f} us")
+    print(f"json.loads(plan)        {timeit(lambda: json.loads(as_json), number=n) / n * 1e6:7.2f} us")
+    print(f"to_bytes()              {timeit(cp.to_bytes, number=n) / n * 1e6:7.2f} us")
+    print(f"from_bytes()            {timeit(lambda: CompactPlan.from_bytes(as_bytes), number=n) / n * 1e6:7.2f} us")
+    print(f"json.dumps(to_json())   {timeit(lambda: json.dumps(cp.to_json()), number=n) / n * 1e6:7.2f} us")
+    print(f"from_json(compact)      {timeit(lambda: CompactPlan.from_json(as_compact_json), number=n) / n * 1e6:7.2f} us")
+    print(f"from_plan() (encode)    {timeit(lambda: CompactPlan.from_plan(plan, prof), number=2000) / 2000 * 1e6:7.2f} us")
+    print(f"expand() (render edge)  {timeit(cp.expand, number=2000) / 2000 * 1e6:7.2f} us")
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 import random
-from copy import deepcopy
+import re
+from functools import lru_cache
+from types import MappingProxyType
+
+from profile_schema import Profile
 
 ###############################################################################
 # Helper: sample without repeating too often
@@ -30,66 +34,289 @@ def _pick_week(items, k=7):
 # Helper: simple "avoid + swap" filter for condition & allergy handling
 ###############################################################################
 
+# bumped whenever the same picks come out as different text; cached pages
+# (result ETags) depend on it
+DRESS_VERSION = 2
+
+
 def _apply_avoids_and_swaps(text, avoids, swaps):
     """
-    If any avoid token appears in text (case-insensitive), try a gentle swap.
+    If any avoid token (lower-case, as _avoids_and_swaps builds them) is
+    mentioned in text (case-insensitive), try a gentle swap.
     'swaps' is a dict like {"white rice":"brown rice", "fried":"grilled"}.
-    If no matching swap, annotate as '(modified)' to signal a safer version.
+    If an avoided token is still mentioned afterwards, annotate as
+    '(modified)' to signal a safer version.
+
+    Tokens match whole words only, and already-qualified mentions such as
+    "no sugar", "low salt" or "unsalted" don't count. Swaps are applied in
+    one pass over the original text, so swapped-in text is never swapped
+    again.
     """
     lowered = text.lower()
+    if not any(bad in lowered and bad and _mentioned(bad, text) for bad in avoids):
+        return text
+
+    present = tuple(src for src in (swaps or {}) if src.lower() in lowered and _mentioned(src, text))
     modified = text
-    changed = False
+    if present:
+        targets = {src.lower(): dst for src, dst in swaps.items()}
+        modified = _swap_pattern(present).sub(
+            lambda m: _match_case(m.group(0), targets[m.group(0).lower()]), text)
 
-    for bad in avoids:
-        if bad and bad.lower() in lowered:
-            # try to find a specific swap
-            replaced_once = False
-            for src, dst in (swaps or {}).items():
-                if src.lower() in modified.lower():
-                    modified = _safe_replace_case_insensitive(modified, src, dst)
-                    replaced_once = True
-                    changed = True
-            if not replaced_once:
-                # generic softening
-                if "(modified" not in modified.lower():
-                    modified += " (modified)"
-                changed = True
+    lowered = modified.lower()
+    if any(bad in lowered and bad and _mentioned(bad, modified) for bad in avoids):
+        # generic softening
+        if "(modified" not in modified.lower():
+            modified += " (modified)"
+    return modified.replace("  ", " ").strip()
+
+
+# a mention is a whole word not already qualified by one of these
+_QUALIFIERS = r"(?<!no )(?<!low )(?<!added )(?<!avoid )"
+
+
+@lru_cache(maxsize=None)
+def _mention_pattern(token):
+    return re.compile(_QUALIFIERS + r"\b" + re.escape(token.lower()) + r"\b", re.IGNORECASE)
 
-    # Small cleanups for double-modification
-    if changed:
-        modified = modified.replace("  ", " ").strip()
-    return modified
 
+def _mentioned(token, text):
+    return _mention_pattern(token).search(text) is not None
 
-def _safe_replace_case_insensitive(text, src, dst):
+
+@lru_cache(maxsize=1024)
+def _swap_pattern(sources):
+    # longest first, so "white rice" wins over "rice"
+    alternatives = "|".join(re.escape(src.lower()) for src in sorted(sources, key=len, reverse=True))
+    return re.compile(_QUALIFIERS + r"\b(?:" + alternatives + r")\b", re.IGNORECASE)
+
+
+def _match_case(found, replacement):
     """
-    Replace src with dst, case-insensitively, preserving overall readability.
+    Keep a capitalised word capitalised after swapping it.
     """
-    idx = text.lower().find(src.lower())
-    if idx == -1:
-        return text
-    return text[:idx] + dst + text[idx + len(src):]
+    if found[:1].isupper() and replacement[:1].islower():
+        return replacement[:1].upper() + replacement[1:]
+    return replacement
 
 
 ###############################################################################
-# Main: generate_plan(profile) -> (plan_dict, updated_profile)
+# MEAL LIBRARIES (Large & varied)
 ###############################################################################
 
-def generate_plan(profile):
-    """
-    Build a 7-day diet plan with structured meals + exercise list + notes.
-    Returns (plan_dict, updated_profile)
+SLOTS = ("breakfast", "lunch", "snack", "dinner")
 
-    Required fields used from profile (with fallbacks):
-      - weight (kg), height (cm) -> BMI
-      - goal: "weight_loss" | "weight_gain" | "fitness" | "strength" (default fitness)
-      - stress: "low" | "medium" | "high"
-      - diet_pref: "veg" | "non-veg" | "vegan" | "both"
-      - allergies: list[str]
-      - conditions: derived from:
-            bp, sugar, thyroid, pcod, cholesterol, heart, kidney, pregnancy
+MEAL_LIBRARY = {
+    "veg": {
+        "breakfast": [
+            "Vegetable oats (no sugar)",
+            "Besan chilla + mint chutney",
+            "Moong dal chilla + curd",
+            "Idli + sambar",
+            "Upma with mixed veggies",
+            "Poha with peas & carrot (no potato)",
+            "Rava uttapam + tomato chutney",
+            "Daliya (broken wheat) porridge + nuts",
+            "Multigrain toast + peanut butter",
+            "Sprouts salad + lemon",
+            "Ragi dosa + chutney",
+            "Vegetable paratha (low oil) + curd",
+        ],
+        "lunch": [
+            "2 chapati + tur dal + mixed veg sabzi + salad",
+            "Brown rice + rajma (small portion) + cucumber salad",
+            "Vegetable khichdi (low GI) + salad",
+            "Chapati + lauki (bottle gourd) sabzi + salad",
+            "Vegetable pulao (low oil) + curd",
+            "2 chapati + paneer curry (low oil) + salad",
+            "Brown rice + sambar + spinach stir-fry",
+            "Millet roti + chana masala + salad",
+            "Curd rice (low salt) + beetroot poriyal",
+            "Palak chole + half bowl rice + salad",
+            "Quinoa pulao + moong dal tadka (light)",
+        ],
+        "snack": [
+            "Fruit bowl (apple/guava/orange) + chia",
+            "Buttermilk (unsalted)",
+            "Roasted chana",
+            "Green tea + murmura",
+            "Cucumber + carrot sticks + hummus",
+            "Handful of almonds/walnuts",
+            "Sprouts chaat (lemon, no potato)",
+            "Greek curd + mixed seeds",
+        ],
+        "dinner": [
+            "1 chapati + mix veg curry (low oil)",
+            "Moong dal khichdi + salad",
+            "Clear veg soup + sautéed veggies",
+            "1 roti + palak paneer (low salt)",
+            "Vegetable upma + cucumber salad",
+            "Soup + multigrain toast",
+            "1 chapati + bottle gourd curry",
+            "Vegetable stew + small millet dosa",
+            "Dal + sautéed beans + salad",
+            "Lentil soup + 1 chapati",
+        ],
+    },
+    "nonveg": {
+        "breakfast": [
+            "2 boiled eggs + multigrain toast",
+            "Oats + milk + nuts",
+            "Chicken sandwich (multigrain, low mayo)",
+            "Egg bhurji + chapati",
+            "Scrambled eggs + spinach",
+            "Egg white omelette + veggies",
+            "Oats pancake + egg white",
+        ],
+        "lunch": [
+            "Grilled chicken + brown rice + salad",
+            "Fish curry + 2 chapati + cucumber raita",
+            "Egg curry + 2 chapati + salad",
+            "Chicken pulao (small portion, low oil) + salad",
+            "Boiled eggs + veg salad + chapati",
+            "Grilled fish + sautéed veggies + small rice",
+            "Chicken curry + millet roti + salad",
+        ],
+        "snack": [
+            "Boiled egg whites + lemon",
+            "Chicken soup (clear)",
+            "Tuna salad (no mayo)",
+            "Greek yogurt + walnuts",
+            "Protein shake (no sugar)",
+        ],
+        "dinner": [
+            "Grilled fish + clear soup",
+            "Chicken stew + multigrain bread",
+            "Egg curry + vegetable soup",
+            "Grilled chicken + sautéed veggies",
+            "Fish tikka + salad",
+        ],
+    },
+    "vegan": {
+        "breakfast": [
+            "Soy milk smoothie + berries + oats",
+            "Vegan oats porridge + nuts",
+            "Chia pudding (unsweetened) + fruit",
+            "Almond butter toast",
+            "Vegan poha (no ghee)",
+            "Tofu scramble + veggies",
+            "Ragi porridge + banana (if allowed)",
+        ],
+        "lunch": [
+            "Quinoa + masoor dal + veggies",
+            "Vegan pulao + cabbage salad",
+            "Chapati + tofu curry",
+            "Vegan khichdi (oil, no ghee)",
+            "Vegetable stew + salad",
+            "Brown rice + beans curry",
+            "Chickpea curry + millet roti",
+        ],
+        "snack": [
+            "Soy yogurt + fruit",
+            "Roasted seeds trail mix",
+            "Vegan smoothie (almond milk)",
+            "Roasted chana",
+            "Carrot + cucumber sticks + hummus",
+        ],
+        "dinner": [
+            "Veg clear soup + salad",
+            "Quinoa + sautéed veggies",
+            "Chapati + veg curry (oil, no ghee)",
+            "Lentil stew + salad",
+            "Tofu curry + small brown rice",
+            "Millet roti + mixed veg curry",
+        ],
+    },
+}
+
+# Safety fallback used when the allergy filter empties a bank
+FALLBACK_MEALS = {
+    "breakfast": "Fruit + oats porridge (no allergen)",
+    "lunch": "Brown rice + lentil curry + salad (no allergen)",
+    "snack": "Roasted chana (no allergen)",
+    "dinner": "Veg clear soup + chapati (no allergen)",
+}
+
+
+###############################################################################
+# CONDITION RULES (avoids + smart swaps + condition notes)
+###############################################################################
+
+CONDITION_RULES = {
+    "diabetes": {
+        "avoid": ["sugar", "white rice", "sweet", "jaggery", "honey", "dessert", "potato"],
+        "swaps": {
+            "white rice": "brown rice",
+            "sugar": "no added sugar",
+            "sweet": "low-GI fruit",
+            "honey": "no sweetener",
+            "jaggery": "no sweetener",
+            "poha": "poha (no potato)",
+        },
+        "tip": "For diabetes: choose low-GI carbs, add fiber/protein to each meal, space meals evenly, and monitor glucose response.",
+    },
+    "bp_or_heart": {
+        "avoid": ["salt", "pickles", "papad", "fried", "butter", "processed", "sausage"],
+        "swaps": {
+            "salt": "low salt",
+            "fried": "grilled",
+            "butter": "olive oil (very little)",
+            "pickle": "salad",
+        },
+        "tip": "For BP/heart/cholesterol: restrict salt and fried foods, prefer grilled/steamed, include leafy greens and pulses.",
+    },
+    "thyroid": {
+        "avoid": ["soy", "cabbage", "cauliflower", "broccoli", "millet (excess)"],
+        "swaps": {
+            "soy": "paneer/tofu (if allowed) or lentils (if vegan avoid soy)",
+            "cabbage": "zucchini",
+            "cauliflower": "bottle gourd",
+        },
+        "tip": "For thyroid: take meds on empty stomach; limit goitrogens (soy, raw cabbage/cauliflower); ensure adequate protein, iodine, selenium.",
+    },
+    "kidney": {
+        "avoid": ["excess protein", "banana", "orange", "tomato (excess)", "spinach (excess)", "salt"],
+        "swaps": {
+            "banana": "apple/pear",
+            "orange": "apple/guava",
+            "salt": "low salt",
+        },
+        "tip": "For kidney: moderate protein and potassium as advised; keep dishes simple and lightly spiced; follow nephrologist guidance.",
+    },
+    "pcod": {
+        "avoid": ["sugary", "dessert", "refined flour", "maida", "soft drink", "juice (packed)"],
+        "swaps": {
+            "dessert": "fruit + curd",
+            "maida": "whole-wheat",
+            "juice": "whole fruit",
+        },
+        "tip": "For PCOD/PCOS: emphasize protein + fiber, low-GI carbs, add strength training, aim for consistent sleep.",
+    },
+    "pregnancy": {
+        "avoid": ["raw papaya", "excess caffeine", "street food", "unpasteurized"],
+        "swaps": {
+            "coffee": "decaf/limit",
+        },
+        "tip": "For pregnancy: small frequent meals; include iron, calcium, folate; hydrate well; avoid unpasteurized foods.",
+    },
+}
+
+###############################################################################
+# Profile context: derived values every part of the plan is built from
+###############################################################################
+
+def _profile_context(profile):
+    """
+    Derive BMI, weight class, normalized prefs, allergies and condition flags.
+    Every plan part (notes, exercise, portions, meals) is a function of this
+    context only, which is what lets regenerate() rebuild just the parts
+    whose inputs changed.
     """
-    # -------- Derive BMI and store back ----------
+    if isinstance(profile, Profile):
+        return _context_from_schema(profile)
+    profile = profile or {}
+
+    # -------- Derive BMI ----------
     try:
         weight = float(profile.get("weight") or 0)
         height_cm = float(profile.get("height") or 0)
@@ -106,10 +333,6 @@ def generate_plan(profile):
     else:
         weight_class = "Obese"
 
-    profile = dict(profile or {})
-    profile["bmi"] = bmi
-    profile["weight_class"] = weight_class
-
     # -------- Read user prefs -----------
     goal = (profile.get("goal") or "fitness").lower()
     stress = (profile.get("stress") or "low").lower()
@@ -141,208 +364,71 @@ def generate_plan(profile):
         "pregnancy": (profile.get("pregnancy") == "yes"),
     }
 
-    ###########################################################################
-    # MEAL LIBRARIES (Large & varied)
-    ###########################################################################
+    # Merged flags to a normalized condition tuple, in CONDITION_RULES order:
+    # notes and swaps iterate it, so a set would make the plan (and its
+    # plan-store hash) depend on PYTHONHASHSEED
+    active_conditions = tuple(key for key, on in cond.items() if on)
 
-    LIB = {
-        "veg": {
-            "breakfast": [
-                "Vegetable oats (no sugar)",
-                "Besan chilla + mint chutney",
-                "Moong dal chilla + curd",
-                "Idli + sambar",
-                "Upma with mixed veggies",
-                "Poha with peas & carrot (no potato)",
-                "Rava uttapam + tomato chutney",
-                "Daliya (broken wheat) porridge + nuts",
-                "Multigrain toast + peanut butter",
-                "Sprouts salad + lemon",
-                "Ragi dosa + chutney",
-                "Vegetable paratha (low oil) + curd",
-            ],
-            "lunch": [
-                "2 chapati + tur dal + mixed veg sabzi + salad",
-                "Brown rice + rajma (small portion) + cucumber salad",
-                "Vegetable khichdi (low GI) + salad",
-                "Chapati + lauki (bottle gourd) sabzi + salad",
-                "Vegetable pulao (low oil) + curd",
-                "2 chapati + paneer curry (low oil) + salad",
-                "Brown rice + sambar + spinach stir-fry",
-                "Millet roti + chana masala + salad",
-                "Curd rice (low salt) + beetroot poriyal",
-                "Palak chole + half bowl rice + salad",
-                "Quinoa pulao + moong dal tadka (light)",
-            ],
-            "snack": [
-                "Fruit bowl (apple/guava/orange) + chia",
-                "Buttermilk (unsalted)",
-                "Roasted chana",
-                "Green tea + murmura",
-                "Cucumber + carrot sticks + hummus",
-                "Handful of almonds/walnuts",
-                "Sprouts chaat (lemon, no potato)",
-                "Greek curd + mixed seeds",
-            ],
-            "dinner": [
-                "1 chapati + mix veg curry (low oil)",
-                "Moong dal khichdi + salad",
-                "Clear veg soup + sautéed veggies",
-                "1 roti + palak paneer (low salt)",
-                "Vegetable upma + cucumber salad",
-                "Soup + multigrain toast",
-                "1 chapati + bottle gourd curry",
-                "Vegetable stew + small millet dosa",
-                "Dal + sautéed beans + salad",
-                "Lentil soup + 1 chapati",
-            ],
-        },
-        "nonveg": {
-            "breakfast": [
-                "2 boiled eggs + multigrain toast",
-                "Oats + milk + nuts",
-                "Chicken sandwich (multigrain, low mayo)",
-                "Egg bhurji + chapati",
-                "Scrambled eggs + spinach",
-                "Egg white omelette + veggies",
-                "Oats pancake + egg white",
-            ],
-            "lunch": [
-                "Grilled chicken + brown rice + salad",
-                "Fish curry + 2 chapati + cucumber raita",
-                "Egg curry + 2 chapati + salad",
-                "Chicken pulao (small portion, low oil) + salad",
-                "Boiled eggs + veg salad + chapati",
-                "Grilled fish + sautéed veggies + small rice",
-                "Chicken curry + millet roti + salad",
-            ],
-            "snack": [
-                "Boiled egg whites + lemon",
-                "Chicken soup (clear)",
-                "Tuna salad (no mayo)",
-                "Greek yogurt + walnuts",
-                "Protein shake (no sugar)",
-            ],
-            "dinner": [
-                "Grilled fish + clear soup",
-                "Chicken stew + multigrain bread",
-                "Egg curry + vegetable soup",
-                "Grilled chicken + sautéed veggies",
-                "Fish tikka + salad",
-            ],
-        },
-        "vegan": {
-            "breakfast": [
-                "Soy milk smoothie + berries + oats",
-                "Vegan oats porridge + nuts",
-                "Chia pudding (unsweetened) + fruit",
-                "Almond butter toast",
-                "Vegan poha (no ghee)",
-                "Tofu scramble + veggies",
-                "Ragi porridge + banana (if allowed)",
-            ],
-            "lunch": [
-                "Quinoa + masoor dal + veggies",
-                "Vegan pulao + cabbage salad",
-                "Chapati + tofu curry",
-                "Vegan khichdi (oil, no ghee)",
-                "Vegetable stew + salad",
-                "Brown rice + beans curry",
-                "Chickpea curry + millet roti",
-            ],
-            "snack": [
-                "Soy yogurt + fruit",
-                "Roasted seeds trail mix",
-                "Vegan smoothie (almond milk)",
-                "Roasted chana",
-                "Carrot + cucumber sticks + hummus",
-            ],
-            "dinner": [
-                "Veg clear soup + salad",
-                "Quinoa + sautéed veggies",
-                "Chapati + veg curry (oil, no ghee)",
-                "Lentil stew + salad",
-                "Tofu curry + small brown rice",
-                "Millet roti + mixed veg curry",
-            ],
-        },
+    return {
+        "bmi": bmi,
+        "weight_class": weight_class,
+        "goal": goal,
+        "stress": stress,
+        "diet_pref": diet_pref,
+        "allergies": allergies,
+        "cond": cond,
+        "active_conditions": active_conditions,
     }
 
-    ###########################################################################
-    # CONDITION RULES (avoids + smart swaps + condition notes)
-    ###########################################################################
 
-    # Merged flags to a normalized condition set for easier processing
-    active_conditions = set()
-    if cond["diabetes"]: active_conditions.add("diabetes")
-    if cond["bp_or_heart"]: active_conditions.add("bp_or_heart")
-    if cond["thyroid"]: active_conditions.add("thyroid")
-    if cond["kidney"]: active_conditions.add("kidney")
-    if cond["pcod"]: active_conditions.add("pcod")
-    if cond["pregnancy"]: active_conditions.add("pregnancy")
-
-    condition_rules = {
-        "diabetes": {
-            "avoid": ["sugar", "white rice", "sweet", "jaggery", "honey", "dessert", "potato"],
-            "swaps": {
-                "white rice": "brown rice",
-                "sugar": "no added sugar",
-                "sweet": "low-GI fruit",
-                "honey": "no sweetener",
-                "jaggery": "no sweetener",
-                "poha": "poha (no potato)",
-            },
-            "tip": "For diabetes: choose low-GI carbs, add fiber/protein to each meal, space meals evenly, and monitor glucose response.",
-        },
-        "bp_or_heart": {
-            "avoid": ["salt", "pickles", "papad", "fried", "butter", "processed", "sausage"],
-            "swaps": {
-                "salt": "low salt",
-                "fried": "grilled",
-                "butter": "olive oil (very little)",
-                "pickle": "salad",
-            },
-            "tip": "For BP/heart/cholesterol: restrict salt and fried foods, prefer grilled/steamed, include leafy greens and pulses.",
-        },
-        "thyroid": {
-            "avoid": ["soy", "cabbage", "cauliflower", "broccoli", "millet (excess)"],
-            "swaps": {
-                "soy": "paneer/tofu (if allowed) or lentils (if vegan avoid soy)",
-                "cabbage": "zucchini",
-                "cauliflower": "bottle gourd",
-            },
-            "tip": "For thyroid: take meds on empty stomach; limit goitrogens (soy, raw cabbage/cauliflower); ensure adequate protein, iodine, selenium.",
-        },
-        "kidney": {
-            "avoid": ["excess protein", "banana", "orange", "tomato (excess)", "spinach (excess)", "salt"],
-            "swaps": {
-                "banana": "apple/pear",
-                "orange": "apple/guava",
-                "salt": "low salt",
-            },
-            "tip": "For kidney: moderate protein and potassium as advised; keep dishes simple and lightly spiced; follow nephrologist guidance.",
-        },
-        "pcod": {
-            "avoid": ["sugary", "dessert", "refined flour", "maida", "soft drink", "juice (packed)"],
-            "swaps": {
-                "dessert": "fruit + curd",
-                "maida": "whole-wheat",
-                "juice": "whole fruit",
-            },
-            "tip": "For PCOD/PCOS: emphasize protein + fiber, low-GI carbs, add strength training, aim for consistent sleep.",
-        },
-        "pregnancy": {
-            "avoid": ["raw papaya", "excess caffeine", "street food", "unpasteurized"],
-            "swaps": {
-                "coffee": "decaf/limit",
-            },
-            "tip": "For pregnancy: small frequent meals; include iron, calcium, folate; hydrate well; avoid unpasteurized foods.",
-        },
+def _context_from_schema(p):
+    """
+    Same context from an already validated Profile: no re-parsing needed.
+    """
+    cond = {
+        "diabetes": p.sugar.value in ("prediabetic", "diabetic"),
+        "bp_or_heart": p.bp.value == "high" or p.heart.value == "yes" or
+                       p.cholesterol.value == "high",
+        "thyroid": p.thyroid.value in ("hypo", "hyper"),
+        "kidney": p.kidney.value == "yes",
+        "pcod": p.pcod.value == "yes",
+        "pregnancy": p.pregnancy.value == "yes",
+    }
+    return {
+        "bmi": p.bmi,
+        "weight_class": p.weight_class,
+        "goal": p.goal.value,
+        "stress": p.stress.value,
+        "diet_pref": p.diet_pref.value,
+        "allergies": set(p.allergies),
+        "cond": cond,
+        "active_conditions": tuple(key for key, on in cond.items() if on),
     }
 
-    ###########################################################################
-    # GOAL / BMI NOTES
-    ###########################################################################
+
+def _profile_dict(profile, ctx):
+    """
+    Plain profile dict with the derived BMI fields stored back.
+    """
+    if isinstance(profile, Profile):
+        return profile.to_dict()
+    profile = dict(profile or {})
+    profile["bmi"] = ctx["bmi"]
+    profile["weight_class"] = ctx["weight_class"]
+    return profile
+
+
+###############################################################################
+# Plan parts
+###############################################################################
+
+def _build_notes(ctx):
+    """
+    Goal/BMI/condition/stress notes followed by lifestyle tips.
+    """
+    weight_class = ctx["weight_class"]
+    goal = ctx["goal"]
+    cond = ctx["cond"]
 
     notes = []
 
@@ -367,18 +453,45 @@ def generate_plan(profile):
         notes.append("Goal: General fitness—mix cardio, strength, and mobility work across the week.")
 
     # Condition notes
-    for key in active_conditions:
-        tip = condition_rules.get(key, {}).get("tip")
+    for key in ctx["active_conditions"]:
+        tip = CONDITION_RULES.get(key, {}).get("tip")
         if tip:
             notes.append(tip)
 
     # Stress note
-    if stress == "high":
+    if ctx["stress"] == "high":
         notes.append("High stress reported: add 10–15 minutes of daily mindfulness (box breathing, body scan) and reduce late-night screen time.")
 
-    ###########################################################################
-    # EXERCISE PLAN (goal + conditions + stress)
-    ###########################################################################
+    # Lifestyle tips (generic + condition + BMI)
+    lifestyle = [
+        "Hydration: 2–3 liters water/day (adjust for kidney/doctor advice).",
+        "Sleep: target 7–8 hours/night; consistent schedule.",
+        "NEAT: stand/move briefly each hour; aim for 8–10k steps/day (tailor to condition).",
+        "Cook at home when possible; keep oils minimal; prioritize whole foods.",
+    ]
+    # condition-specific add-ons already in notes; add a couple more practicals:
+    if cond["diabetes"]:
+        lifestyle.append("Pair carbs with protein/healthy fats to blunt glucose spikes (e.g., curd/nuts with fruit).")
+    if cond["bp_or_heart"]:
+        lifestyle.append("Rinse canned foods; prefer fresh; watch packaged snacks for hidden sodium.")
+    if cond["thyroid"]:
+        lifestyle.append("Keep a consistent routine for thyroid meds; avoid coffee/iron supplements within 4 hours of dose.")
+    if cond["kidney"]:
+        lifestyle.append("Track daily fluids and potassium/phosphorus per clinician plan; prefer simple soups and boiled veggies.")
+    if cond["pcod"]:
+        lifestyle.append("Aim for 25–35 g fiber/day; include flaxseed/chia; maintain strength training schedule.")
+    if cond["pregnancy"]:
+        lifestyle.append("Include folate, iron, calcium sources; avoid unpasteurized dairy and high-mercury fish.")
+
+    return notes + lifestyle
+
+
+def _build_exercise(ctx):
+    """
+    Exercise list from goal + stress + condition constraints.
+    """
+    goal = ctx["goal"]
+    cond = ctx["cond"]
 
     # Base by goal
     base_exercise = []
@@ -406,7 +519,7 @@ def generate_plan(profile):
         ]
 
     # Stress relaxation
-    if stress == "high":
+    if ctx["stress"] == "high":
         base_exercise.append("Mindfulness/meditation 10–15 mins daily (e.g., box breathing)")
 
     # Condition constraints/edits
@@ -423,62 +536,75 @@ def generate_plan(profile):
     if cond["pregnancy"]:
         base_exercise.append("Light walking; prenatal yoga (only with clinician approval)")
 
-    exercise_plan = list(dict.fromkeys(base_exercise))  # de-duplicate, keep order
+    return list(dict.fromkeys(base_exercise))  # de-duplicate, keep order
 
-    ###########################################################################
-    # Build 7-Day Diet Plan (structured: breakfast/lunch/snack/dinner)
-    ###########################################################################
 
-    def pick_meal_banks(preference):
-        if preference == "veg":
-            return deepcopy(LIB["veg"])
-        elif preference == "nonveg":
-            return deepcopy(LIB["nonveg"])
-        elif preference == "vegan":
-            return deepcopy(LIB["vegan"])
-        else:
-            # BOTH: merge veg + nonveg + vegan (without duplicates)
-            both = {"breakfast": [], "lunch": [], "snack": [], "dinner": []}
-            seen = set()
-            for pref_key in ("veg", "nonveg", "vegan"):
-                for slot in ("breakfast", "lunch", "snack", "dinner"):
-                    for item in LIB[pref_key][slot]:
-                        if item not in seen:
-                            seen.add(item)
-                            both[slot].append(item)
-            return both
-
-    meals_bank = pick_meal_banks(diet_pref)
+def _portion_note(ctx):
+    """
+    Portion guidance by BMI/goal (light annotation appended to main meals).
+    """
+    goal = ctx["goal"]
+    weight_class = ctx["weight_class"]
+    if goal == "weight_loss" or weight_class in ("Overweight", "Obese"):
+        return " (controlled portion)"
+    if goal == "weight_gain" or weight_class == "Underweight":
+        return " (generous portion)"
+    return ""
+
+
+@lru_cache(maxsize=None)
+def _preference_bank(preference):
+    """
+    slot -> tuple of library items for a diet preference (before allergies).
+    """
+    if preference in ("veg", "nonveg", "vegan"):
+        return {slot: tuple(MEAL_LIBRARY[preference][slot]) for slot in SLOTS}
+    # BOTH: merge veg + nonveg + vegan (without duplicates)
+    meals_bank = {slot: [] for slot in SLOTS}
+    seen = set()
+    for pref_key in ("veg", "nonveg", "vegan"):
+        for slot in SLOTS:
+            for item in MEAL_LIBRARY[pref_key][slot]:
+                if item not in seen:
+                    seen.add(item)
+                    meals_bank[slot].append(item)
+    return {slot: tuple(items) for slot, items in meals_bank.items()}
+
+
+def _meal_banks(ctx, slots=SLOTS):
+    """
+    Meal bank for the diet preference with allergen-containing items removed
+    (only for `slots`, when a caller needs just some of them).
+    """
+    allergies = frozenset(ctx["allergies"])
+    return {slot: list(_filtered_bank(ctx["diet_pref"], allergies, slot)) for slot in slots}
 
+
+@lru_cache(maxsize=4096)
+def _filtered_bank(preference, allergies, slot):
+    items = _preference_bank(preference)[slot]
+    if not allergies:
+        return items
     # Allergy filter (removes items containing allergen tokens)
-    if allergies:
-        def safe_filter(items):
-            out = []
-            for item in items:
-                text = item.lower()
-                if any(a in text for a in allergies):
-                    continue
-                out.append(item)
-            return out
-
-        for slot in ("breakfast", "lunch", "snack", "dinner"):
-            meals_bank[slot] = safe_filter(meals_bank[slot])
-
-        # Safety fallback to avoid empty banks
-        if not meals_bank["breakfast"]:
-            meals_bank["breakfast"] = ["Fruit + oats porridge (no allergen)"]
-        if not meals_bank["lunch"]:
-            meals_bank["lunch"] = ["Brown rice + lentil curry + salad (no allergen)"]
-        if not meals_bank["snack"]:
-            meals_bank["snack"] = ["Roasted chana (no allergen)"]
-        if not meals_bank["dinner"]:
-            meals_bank["dinner"] = ["Veg clear soup + chapati (no allergen)"]
-
-    # Per-condition avoids + swaps aggregated
+    items = tuple(item for item in items if not any(a in item.lower() for a in allergies))
+    # Safety fallback to avoid empty banks
+    return items or (FALLBACK_MEALS[slot],)
+
+
+def _avoids_and_swaps(ctx):
+    """
+    Per-condition avoids + swaps aggregated, plus gentle goal-based swaps.
+    Shared between calls: (frozenset, read-only mapping).
+    """
+    return _combined_rules(tuple(ctx["active_conditions"]), ctx["goal"], frozenset(ctx.get("allergies") or ()))
+
+
+@lru_cache(maxsize=4096)
+def _combined_rules(active_conditions, goal, allergies):
     combined_avoids = set()
     combined_swaps = {}
     for key in active_conditions:
-        rules = condition_rules.get(key) or {}
+        rules = CONDITION_RULES.get(key) or {}
         for bad in rules.get("avoid", []):
             combined_avoids.add(bad.lower())
         for src, dst in (rules.get("swaps") or {}).items():
@@ -495,68 +621,388 @@ def generate_plan(profile):
         combined_swaps.setdefault("no added sugar", "honey (small)")
     # fitness/strength keep defaults
 
-    # Build weekly picks
-    week_breakfasts = _pick_week(meals_bank["breakfast"], 7)
-    week_lunches = _pick_week(meals_bank["lunch"], 7)
-    week_snacks = _pick_week(meals_bank["snack"], 7)
-    week_dinners = _pick_week(meals_bank["dinner"], 7)
+    # a swap must not bring an allergen back in; the avoid gets annotated instead
+    if allergies:
+        combined_swaps = {
+            src: dst for src, dst in combined_swaps.items()
+            if not any(a in dst.lower() for a in allergies)
+        }
+
+    return frozenset(combined_avoids), MappingProxyType(combined_swaps)
+
 
-    # Apply avoids/swaps per item
-    def adapt(item):
-        return _apply_avoids_and_swaps(item, combined_avoids, combined_swaps)
+def _dress_meal(slot, base, avoids, swaps, portion_note):
+    """
+    Final slot text: avoids/swaps applied, portion note on main meals only.
+    """
+    text = _apply_avoids_and_swaps(base, avoids, swaps)
+    if slot != "snack":
+        text += portion_note
+    return text
+
+
+###############################################################################
+# Main: generate_plan(profile) -> (plan_dict, updated_profile)
+###############################################################################
+
+def generate_plan(profile):
+    """
+    Build a 7-day diet plan with structured meals + exercise list + notes.
+    Returns (plan_dict, updated_profile)
+
+    Required fields used from profile (with fallbacks):
+      - weight (kg), height (cm) -> BMI
+      - goal: "weight_loss" | "weight_gain" | "fitness" | "strength" (default fitness)
+      - stress: "low" | "medium" | "high"
+      - diet_pref: "veg" | "non-veg" | "vegan" | "both"
+      - allergies: list[str]
+      - conditions: derived from:
+            bp, sugar, thyroid, pcod, cholesterol, heart, kidney, pregnancy
+
+    `profile` may also be a validated profile_schema.Profile.
+    """
+    ctx = _profile_context(profile)
+    profile = _profile_dict(profile, ctx)
+
+    notes = _build_notes(ctx)
+    exercise_plan = _build_exercise(ctx)
+
+    ###########################################################################
+    # Build 7-Day Diet Plan (structured: breakfast/lunch/snack/dinner)
+    ###########################################################################
+
+    meals_bank = _meal_banks(ctx)
+    combined_avoids, combined_swaps = _avoids_and_swaps(ctx)
+    portion_note = _portion_note(ctx)
+
+    # Build weekly picks
+    week = {slot: _pick_week(meals_bank[slot], 7) for slot in SLOTS}
 
     diet_plan = {}
     for i in range(7):
-        b = adapt(week_breakfasts[i])
-        l = adapt(week_lunches[i])
-        s = adapt(week_snacks[i])
-        d = adapt(week_dinners[i])
-
-        # Portion guidance by BMI/goal (light annotation)
-        portion_note = ""
-        if goal == "weight_loss" or weight_class in ("Overweight", "Obese"):
-            portion_note = " (controlled portion)"
-        elif goal == "weight_gain" or weight_class == "Underweight":
-            portion_note = " (generous portion)"
-
         diet_plan[f"Day {i+1}"] = {
-            "breakfast": b + portion_note,
-            "lunch": l + portion_note,
-            "snack": s,
-            "dinner": d + portion_note,
+            slot: _dress_meal(slot, week[slot][i], combined_avoids, combined_swaps, portion_note)
+            for slot in SLOTS
         }
 
-    # Lifestyle tips (generic + condition + BMI)
-    lifestyle = [
-        "Hydration: 2–3 liters water/day (adjust for kidney/doctor advice).",
-        "Sleep: target 7–8 hours/night; consistent schedule.",
-        "NEAT: stand/move briefly each hour; aim for 8–10k steps/day (tailor to condition).",
-        "Cook at home when possible; keep oils minimal; prioritize whole foods.",
-    ]
-    # condition-specific add-ons already in notes; add a couple more practicals:
-    if cond["diabetes"]:
-        lifestyle.append("Pair carbs with protein/healthy fats to blunt glucose spikes (e.g., curd/nuts with fruit).")
-    if cond["bp_or_heart"]:
-        lifestyle.append("Rinse canned foods; prefer fresh; watch packaged snacks for hidden sodium.")
-    if cond["thyroid"]:
-        lifestyle.append("Keep a consistent routine for thyroid meds; avoid coffee/iron supplements within 4 hours of dose.")
-    if cond["kidney"]:
-        lifestyle.append("Track daily fluids and potassium/phosphorus per clinician plan; prefer simple soups and boiled veggies.")
-    if cond["pcod"]:
-        lifestyle.append("Aim for 25–35 g fiber/day; include flaxseed/chia; maintain strength training schedule.")
-    if cond["pregnancy"]:
-        lifestyle.append("Include folate, iron, calcium sources; avoid unpasteurized dairy and high-mercury fish.")
-
     # Compose final plan object
     plan = {
         "diet_plan": diet_plan,        # dict: Day -> {breakfast,lunch,snack,dinner}
         "exercise_plan": exercise_plan,  # list of strings
-        "notes": notes + lifestyle,    # combined recommendations
+        "notes": notes,                # combined recommendations
+        "base_meals": week,            # slot -> 7 bank items before avoids/swaps/portion
     }
 
     return plan, profile
 
 
+###############################################################################
+# Incremental: regenerate(plan, old_profile, new_profile) -> (plan, profile)
+###############################################################################
+
+def regenerate(plan, old_profile, new_profile):
+    """
+    Update an existing plan after profile fields change, keeping every part
+    whose inputs did not change exactly as it was.
+
+      - notes         <- weight class, goal, stress, conditions
+      - exercise_plan <- goal, stress, conditions
+      - meals         <- diet_pref (full re-pick), allergies (re-pick only the
+                         affected meals), avoids/swaps/portion (re-dress the
+                         same picks)
+
+    The picks come from plan["base_meals"]; plans saved before it existed
+    are mapped back from their texts (see _legacy_bases).
+    Returns (plan_dict, updated_profile) like generate_plan.
+    """
+    if not plan or not plan.get("diet_plan"):
+        return generate_plan(new_profile)
+
+    old = _profile_context(old_profile)
+    new = _profile_context(new_profile)
+    profile = _profile_dict(new_profile, new)
+
+    # A different preference means a different bank: nothing to keep.
+    if old["diet_pref"] != new["diet_pref"]:
+        return generate_plan(new_profile)
+
+    out = {
+        "diet_plan": plan["diet_plan"],
+        "exercise_plan": plan.get("exercise_plan") or [],
+        "notes": plan.get("notes") or [],
+    }
+    if plan.get("base_meals"):
+        out["base_meals"] = plan["base_meals"]
+
+    if (old["weight_class"], old["goal"], old["stress"], old["active_conditions"]) != \
+            (new["weight_class"], new["goal"], new["stress"], new["active_conditions"]):
+        out["notes"] = _build_notes(new)
+
+    if (old["goal"], old["stress"], old["active_conditions"]) != \
+            (new["goal"], new["stress"], new["active_conditions"]):
+        out["exercise_plan"] = _build_exercise(new)
+
+    old_dress = _avoids_and_swaps(old) + (_portion_note(old),)
+    new_dress = _avoids_and_swaps(new) + (_portion_note(new),)
+    new_allergies = new["allergies"] - old["allergies"]
+    redress = old_dress != new_dress
+    if not redress and not new_allergies:
+        return out, profile
+
+    days = list(out["diet_plan"].keys())
+    bases = _stored_bases(plan, len(days))
+    if bases is None:
+        bases = _legacy_bases(out["diet_plan"], days, old, old_dress, new_allergies, redress)
+
+    # Slots without a usable pick are re-picked; a kept pick is re-dressed
+    # only if the rules changed, otherwise its text stays as it was.
+    refill = {slot: [] for slot in SLOTS}
+    for slot in SLOTS:
+        for i, base in enumerate(bases[slot]):
+            if base is _KEEP:
+                continue
+            if base is None or any(a in base.lower() for a in new_allergies):
+                bases[slot][i] = None
+                refill[slot].append(i)
+
+    refill_slots = tuple(slot for slot in SLOTS if refill[slot])
+    if refill_slots:
+        new_bank = _meal_banks(new, refill_slots)
+        for slot in refill_slots:
+            missing = refill[slot]
+            used = set(b for b in bases[slot] if isinstance(b, str))
+            fresh = [item for item in new_bank[slot] if item not in used]
+            for i, item in zip(missing, _pick_week(fresh or new_bank[slot], len(missing))):
+                bases[slot][i] = item
+
+    diet_plan = {}
+    for i, day in enumerate(days):
+        row = dict(out["diet_plan"][day])
+        for slot in SLOTS:
+            if redress or i in refill[slot]:
+                row[slot] = _dress_meal(slot, bases[slot][i], *new_dress)
+        diet_plan[day] = row
+    out["diet_plan"] = diet_plan
+    if all(isinstance(b, str) for slot in SLOTS for b in bases[slot]):
+        out["base_meals"] = bases
+    else:
+        out.pop("base_meals", None)
+
+    return out, profile
+
+
+def _stored_bases(plan, n_days):
+    """
+    Copy of plan["base_meals"] if it covers every slot of every day.
+    """
+    stored = plan.get("base_meals")
+    if not isinstance(stored, dict):
+        return None
+    bases = {slot: list(stored.get(slot) or ()) for slot in SLOTS}
+    if any(len(bases[slot]) != n_days or not all(isinstance(b, str) for b in bases[slot]) for slot in SLOTS):
+        return None
+    return bases
+
+
+# legacy slot whose pick is unknown but needs no change
+_KEEP = object()
+
+
+def _legacy_bases(diet_plan, days, old, old_dress, new_allergies, redress):
+    """
+    Bank items of a plan without base_meals, mapped back from slot texts.
+
+    With unchanged rules only items containing a new allergen are dressed
+    and looked for; every other slot keeps its text (_KEEP). If the rules
+    changed every slot needs its base, and a slot whose text no item
+    dresses to (None) is re-picked.
+    """
+    old_bank = _meal_banks(old)
+    legacy_dress = _legacy_rules(old) + old_dress[2:]
+    bases = {slot: [] for slot in SLOTS}
+    for slot in SLOTS:
+        if redress:
+            candidates = old_bank[slot]
+        else:
+            candidates = [item for item in old_bank[slot] if any(a in item.lower() for a in new_allergies)]
+        # texts saved before whole-word matching were dressed by the v1 filter
+        base_of = {_dress_meal_v1(slot, item, *legacy_dress): item for item in candidates}
+        base_of.update((_dress_meal(slot, item, *old_dress), item) for item in candidates)
+        for day in days:
+            base = base_of.get(diet_plan[day].get(slot))
+            # unchanged rules: an unmatched text simply has no new allergen
+            bases[slot].append(base if base is not None or redress else _KEEP)
+    return bases
+
+
+def upgrade_plan(plan, profile):
+    """
+    Plan saved before base_meals, with every meal re-dressed by the current
+    avoid/swap rules and base_meals filled in. Picks are kept; a slot whose
+    text maps back to no bank item stays as it was. Plans that already
+    carry base_meals are returned as they are.
+    """
+    if not plan or not plan.get("diet_plan"):
+        return plan
+    days = list(plan["diet_plan"].keys())
+    if _stored_bases(plan, len(days)) is not None:
+        return plan
+
+    ctx = _profile_context(profile)
+    dress = _avoids_and_swaps(ctx) + (_portion_note(ctx),)
+    bases = _legacy_bases(plan["diet_plan"], days, ctx, dress, frozenset(), True)
+
+    diet_plan = {}
+    for i, day in enumerate(days):
+        row = dict(plan["diet_plan"][day])
+        for slot in SLOTS:
+            if bases[slot][i] is not None:
+                row[slot] = _dress_meal(slot, bases[slot][i], *dress)
+        diet_plan[day] = row
+    out = dict(plan, diet_plan=diet_plan)
+    if all(b is not None for slot in SLOTS for b in bases[slot]):
+        out["base_meals"] = bases
+    return out
+
+
+###############################################################################
+# Legacy: the avoid/swap filter plans were dressed with before whole-word
+# matching. Only used to map those texts back to their bank items.
+###############################################################################
+
+def _legacy_rules(ctx):
+    """
+    (avoids, swaps) as the v1 filter got them: swaps not yet dropped for
+    allergens.
+    """
+    return _combined_rules(tuple(ctx["active_conditions"]), ctx["goal"], frozenset())
+
+
+def _dress_meal_v1(slot, base, avoids, swaps, portion_note):
+    text = _apply_avoids_and_swaps_v1(base, avoids, swaps)
+    if slot != "snack":
+        text += portion_note
+    return text
+
+
+def _apply_avoids_and_swaps_v1(text, avoids, swaps):
+    """
+    Substring matching; each avoid found re-applies every swap found, and
+    swaps are applied to their own output.
+    """
+    lowered = text.lower()
+    modified = text
+    changed = False
+
+    for bad in avoids:
+        if bad and bad.lower() in lowered:
+            replaced_once = False
+            for src, dst in (swaps or {}).items():
+                if src.lower() in modified.lower():
+                    modified = _replace_first_v1(modified, src, dst)
+                    replaced_once = True
+                    changed = True
+            if not replaced_once:
+                if "(modified" not in modified.lower():
+                    modified += " (modified)"
+                changed = True
+
+    if changed:
+        modified = modified.replace("  ", " ").strip()
+    return modified
+
+
+def _replace_first_v1(text, src, dst):
+    idx = text.lower().find(src.lower())
+    if idx == -1:
+        return text
+    return text[:idx] + dst + text[idx + len(src):]
+
+
+###############################################################################
+# Group: generate_group_plan(profiles) -> (plan_dict, updated_profiles)
+###############################################################################
+
+def _shared_diet_pref(prefs):
+    """
+    Strictest preference everyone can eat: vegan > veg > nonveg-only > both.
+    """
+    if "vegan" in prefs:
+        return "vegan"
+    if "veg" in prefs:
+        return "veg"
+    if prefs == {"nonveg"}:
+        return "nonveg"
+    return "both"
+
+
+def generate_group_plan(profiles):
+    """
+    One shared 7-day meal grid for a household/cafeteria group.
+
+    The bank is the strictest shared preference minus everyone's allergens,
+    and avoids/swaps are merged across every member's conditions. Goal
+    swaps apply only when all members share the goal, since weight-loss
+    and weight-gain swaps pull in opposite directions. The grid is picked
+    and adapted once; each member gets their own portion note, exercise
+    list and notes.
+
+    Returns (plan_dict, updated_profiles) where plan_dict is
+      {"diet_plan": {Day -> {slot: meal}},   # shared, no portion notes
+       "members": [{"name", "portion", "exercise_plan", "notes"}, ...]}
+    Use member_diet_plan(plan, i) for one member's annotated grid.
+    """
+    profiles = list(profiles)
+    if not profiles:
+        raise ValueError("generate_group_plan needs at least one profile")
+    contexts = [_profile_context(p) for p in profiles]
+
+    goals = set(ctx["goal"] for ctx in contexts)
+    shared = {
+        "diet_pref": _shared_diet_pref(set(ctx["diet_pref"] for ctx in contexts)),
+        "allergies": set().union(*(ctx["allergies"] for ctx in contexts)),
+        "active_conditions": tuple(key for key in CONDITION_RULES
+                                   if any(key in ctx["active_conditions"] for ctx in contexts)),
+        "goal": goals.pop() if len(goals) == 1 else "fitness",
+    }
+
+    meals_bank = _meal_banks(shared)
+    combined_avoids, combined_swaps = _avoids_and_swaps(shared)
+
+    week = {slot: _pick_week(meals_bank[slot], 7) for slot in SLOTS}
+    diet_plan = {}
+    for i in range(7):
+        diet_plan[f"Day {i+1}"] = {
+            slot: _dress_meal(slot, week[slot][i], combined_avoids, combined_swaps, "")
+            for slot in SLOTS
+        }
+
+    members = []
+    updated = []
+    for profile, ctx in zip(profiles, contexts):
+        profile = _profile_dict(profile, ctx)
+        updated.append(profile)
+        members.append({
+            "name": profile.get("name"),
+            "portion": _portion_note(ctx),
+            "exercise_plan": _build_exercise(ctx),
+            "notes": _build_notes(ctx),
+        })
+
+    return {"diet_plan": diet_plan, "members": members}, updated
+
+
+def member_diet_plan(plan, index):
+    """
+    The shared grid with member `index`'s portion note on the main meals.
+    """
+    portion_note = plan["members"][index]["portion"]
+    return {
+        day: {slot: text + portion_note if slot != "snack" else text for slot, text in meals.items()}
+        for day, meals in plan["diet_plan"].items()
+    }
+
+
 ###############################################################################
 # If you want to quick-test locally:
 ###############################################################################
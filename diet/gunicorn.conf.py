@@ -0,0 +1,29 @@
+# gunicorn.conf.py
+# Run from this directory:  gunicorn app:app
+import multiprocessing
+
+bind = "0.0.0.0:8000"
+workers = multiprocessing.cpu_count() * 2 + 1
+# threaded workers: an open /jobs/<id>/events stream holds one thread,
+# not a whole worker
+threads = 4
+
+# Import the app (and warm it up) once in the master; workers are forked
+# afterwards and share the warmed caches copy-on-write.
+preload_app = True
+
+
+def when_ready(server):
+    # preloaded app is imported before this hook and before any worker forks
+    if server.cfg.preload_app:
+        from app import app
+        from warmup import warm_up
+        warm_up(app, freeze=True)
+
+
+def post_worker_init(worker):
+    # without preload each worker warms itself before accepting connections;
+    # with preload this is a no-op since the forked state is already warm
+    from app import app
+    from warmup import warm_up
+    warm_up(app)
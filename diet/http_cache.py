@@ -0,0 +1,178 @@
+# http_cache.py
+# -*- coding: utf-8 -*-
+"""
+HTTP caching + compression helpers.
+
+  - asset_url(filename): static URL with a content fingerprint (?v=...);
+    fingerprinted requests are served with a one-year immutable
+    Cache-Control, so repeat visits never re-download them.
+  - conditional(etag, last_modified): early 304 for If-None-Match /
+    If-Modified-Since, before any template rendering.
+  - gzip (or brotli, when the optional `brotli` package is installed)
+    for text responses above COMPRESS_MIN_SIZE; static files are
+    compressed once per process and cached.
+"""
+import gzip
+import hashlib
+import json
+from functools import lru_cache
+from pathlib import Path
+
+from flask import request, url_for, current_app
+from werkzeug.security import safe_join
+
+# Optional brotli support
+BROTLI_AVAILABLE = False
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except Exception:
+    BROTLI_AVAILABLE = False
+
+COMPRESSIBLE = {
+    "text/html", "text/css", "text/plain", "text/javascript",
+    "application/javascript", "application/json", "image/svg+xml",
+}
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+###############################################################################
+# Fingerprinted static assets
+###############################################################################
+
+@lru_cache(maxsize=256)
+def file_fingerprint(path):
+    """
+    Short content hash of a file (cached; assets only change on deploy).
+    """
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()[:12]
+
+
+def asset_url(filename):
+    path = Path(current_app.static_folder, filename)
+    return url_for("static", filename=filename, v=file_fingerprint(str(path)))
+
+
+def asset_file_url(filename):
+    """
+    file:// URL of a static asset, for HTML-to-PDF renderers that cannot
+    fetch from the app itself.
+    """
+    return Path(current_app.static_folder, filename).resolve().as_uri()
+
+
+def template_fingerprint(name):
+    return file_fingerprint(str(Path(current_app.root_path, current_app.template_folder, name)))
+
+
+###############################################################################
+# Conditional GET
+###############################################################################
+
+def content_etag(*parts):
+    """
+    Stable ETag value for JSON-able parts (plan, profile, template version...).
+    """
+    raw = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def conditional(etag, last_modified=None):
+    """
+    True if the client's cached copy is still valid (-> answer 304).
+    ETags are weak because the same page may be sent gzip'd or not.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def cache_private(response, etag, last_modified=None):
+    """
+    Session-bound page: browser may keep it but must revalidate each time.
+    """
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+###############################################################################
+# Compression
+###############################################################################
+
+def _encode(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+@lru_cache(maxsize=64)
+def _compressed_file(path, fingerprint, encoding):
+    # fingerprint is part of the key so a changed file is recompressed
+    return _encode(Path(path).read_bytes(), encoding)
+
+
+def _pick_encoding():
+    accept = request.accept_encodings
+    if BROTLI_AVAILABLE and accept["br"]:
+        return "br"
+    if accept["gzip"]:
+        return "gzip"
+    return None
+
+
+def _after_request(response):
+    app = current_app
+    is_static = request.endpoint == "static"
+
+    if is_static and response.status_code == 200 and request.args.get("v"):
+        path = safe_join(app.static_folder, request.view_args.get("filename", ""))
+        if path and request.args["v"] == file_fingerprint(path):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+
+    if (response.status_code != 200 or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE):
+        return response
+    encoding = _pick_encoding()
+    if encoding is None:
+        return response
+
+    if response.direct_passthrough:
+        # send_file response: compress static files once and reuse the bytes
+        if not is_static:
+            return response
+        path = safe_join(app.static_folder, request.view_args.get("filename", ""))
+        if not path or Path(path).stat().st_size < app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        body = _compressed_file(path, file_fingerprint(path), encoding)
+        response.close()
+        response.direct_passthrough = False
+        etag, _ = response.get_etag()
+        if etag:
+            # weak: same content, different encoding; still matches on revalidation
+            response.set_etag(etag, weak=True)
+    else:
+        data = response.get_data()
+        if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        body = _encode(data, encoding)
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_http_cache(app):
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    app.jinja_env.globals["asset_url"] = asset_url
+    app.after_request(_after_request)
@@ -0,0 +1,344 @@
+# jobs.py
+# -*- coding: utf-8 -*-
+"""
+Background jobs with streamed progress.
+
+A long batch operation (bulk generation, regenerating every stored plan)
+runs in a thread. The request that starts it returns straight away with
+a job id, and clients follow it with
+
+  GET /jobs/<id>/events     text/event-stream
+
+which sends `progress` events (items done, throughput, ETA), one `result`
+event per finished item as it completes, and a final `end` event. Result
+events carry their sequence number as the SSE id, so a reconnecting
+EventSource resumes from Last-Event-ID without missing or repeating
+results. A comment line is sent while nothing happens so proxies don't
+time the connection out.
+
+  registry = JobRegistry("database.db")
+  job = registry.submit("generate", total=len(items), work=lambda job: ...)
+
+`work(job)` is a generator yielding one JSON-able result per item; it
+checks job.cancelled itself and returns at a point where everything it
+reported is consistent (e.g. after committing a chunk).
+
+The work runs in the process that accepted it, but job state, results
+and the cancel flag live in SQLite (jobs, job_results), so any gunicorn
+worker can answer /jobs/<id>, stream its events or cancel it, and
+max_running holds for the whole host. The running process renews a lease
+on its jobs; a job whose process died is marked failed once the lease
+runs out.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+PROGRESS_INTERVAL = 0.5    # s between progress events while results stream
+HEARTBEAT_INTERVAL = 15.0  # s of silence before a keep-alive comment
+FLUSH_INTERVAL = 0.25      # s the runner buffers results before writing them
+POLL_INTERVAL = 0.25       # s between checks of a streamed job with nothing new
+LEASE_RENEW = 1.0          # s between lease renewals (and cancel-flag reads)
+LEASE_TIMEOUT = 30.0       # s without renewal before a running job counts as lost
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    total INTEGER,
+    done INTEGER NOT NULL DEFAULT 0,
+    dropped INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    error TEXT,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    lease REAL
+);
+CREATE TABLE IF NOT EXISTS job_results (
+    job TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (job, seq)
+) WITHOUT ROWID;
+"""
+
+COLUMNS = "id, kind, total, done, dropped, status, error, cancelled, created, started, finished, lease"
+ACTIVE = ("queued", "running")
+
+
+class Job:
+    """
+    One job row. progress()/cancel() work from any process; the process
+    running the job also buffers its results here until they are written.
+    """
+
+    def __init__(self, registry, job_id, kind=None):
+        self.registry = registry
+        self.id = job_id
+        self.kind = kind
+        self.cancelled = False   # refreshed from the row by the running process
+        self._buffer = []
+        self._seq = 0
+        self._flushed = time.monotonic()
+
+    def progress(self):
+        """
+        {"id", "kind", "status", "done", "total", "rate", "eta_s", "elapsed_s", "error"}
+        """
+        row = self.registry._row(self.id)
+        return _progress(row) if row else None
+
+    def cancel(self):
+        with self.registry._write() as con:
+            con.execute("UPDATE jobs SET cancelled = 1 WHERE id = ?", (self.id,))
+
+    def _add(self, result):
+        self._buffer.append(json.dumps(result, separators=(",", ":")))
+        if time.monotonic() - self._flushed >= FLUSH_INTERVAL:
+            self._flush()
+
+    def _flush(self, **fields):
+        """
+        Write buffered results, the done count and `fields` in one
+        transaction, and pick up a cancel request from any worker.
+        """
+        keep = self.registry.keep_results
+        rows = [(self.id, self._seq + i, body) for i, body in enumerate(self._buffer)]
+        self._seq += len(rows)
+        self._buffer = []
+        self._flushed = time.monotonic()
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        with self.registry._write() as con:
+            con.executemany("INSERT INTO job_results (job, seq, body) VALUES (?, ?, ?)", rows)
+            # newest results only; `dropped` counts the ones that fell off the front
+            dropped = max(0, self._seq - keep)
+            con.execute("DELETE FROM job_results WHERE job = ? AND seq < ?", (self.id, dropped))
+            con.execute(
+                f"UPDATE jobs SET done = ?, dropped = ?, lease = ?{', ' + sets if sets else ''} WHERE id = ?",
+                [self._seq, dropped, time.time()] + list(fields.values()) + [self.id],
+            )
+            if con.execute("SELECT cancelled FROM jobs WHERE id = ?", (self.id,)).fetchone()[0]:
+                self.cancelled = True
+
+    def _results_after(self, seen, limit=1000):
+        """
+        (seq of the first result returned, [result, ...]) after `seen`.
+        """
+        rows = self.registry._read().execute(
+            "SELECT seq, body FROM job_results WHERE job = ? AND seq >= ? ORDER BY seq LIMIT ?",
+            (self.id, seen, limit),
+        ).fetchall()
+        return (rows[0][0] if rows else seen), [json.loads(body) for _, body in rows]
+
+
+def _progress(row):
+    (job_id, kind, total, done, _dropped, status, error, _cancelled,
+     _created, started, finished, _lease) = row
+    end = finished or time.time()
+    elapsed = end - started if started else 0.0
+    rate = done / elapsed if elapsed else 0.0
+    remaining = max(0, (total or 0) - done)
+    eta = remaining / rate if rate and status in ACTIVE else None
+    return {
+        "id": job_id, "kind": kind, "status": status,
+        "done": done, "total": total,
+        "rate": round(rate, 1), "eta_s": None if eta is None else round(eta, 1),
+        "elapsed_s": round(elapsed, 2), "error": error,
+    }
+
+
+###############################################################################
+# Registry
+###############################################################################
+
+class JobRegistry:
+    """
+    Jobs of every worker sharing the SQLite file at `path`. At most
+    `max_running` run at once on the host; finished jobs are kept for
+    `keep_seconds` so clients can still read their results.
+    """
+
+    def __init__(self, path, max_running=2, keep_seconds=3600, keep_results=10000):
+        self.path = path
+        self.max_running = max_running
+        self.keep_seconds = keep_seconds
+        self.keep_results = keep_results
+        self._local = threading.local()
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _read(self):
+        con = getattr(self._local, "con", None)
+        # a connection must not cross a fork (preloaded master -> worker)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._local.con, self._local.pid = con, os.getpid()
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    con.executescript(SCHEMA)
+                    self._ready = True
+        return con
+
+    def _write(self):
+        return _Immediate(self._read())
+
+    def _row(self, job_id):
+        self._expire()
+        return self._read().execute(f"SELECT {COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def _expire(self):
+        """
+        Fail running jobs whose process stopped renewing their lease.
+        """
+        now = time.time()
+        if not self._read().execute(
+                "SELECT 1 FROM jobs WHERE status IN (?, ?) AND lease < ? LIMIT 1",
+                ACTIVE + (now - LEASE_TIMEOUT,)).fetchone():
+            return
+        with self._write() as con:
+            con.execute(
+                "UPDATE jobs SET status = 'failed', error = 'worker lost', finished = ? "
+                "WHERE status IN (?, ?) AND lease < ?",
+                (now,) + ACTIVE + (now - LEASE_TIMEOUT,),
+            )
+
+    def running(self):
+        self._expire()
+        return self._read().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", ACTIVE).fetchone()[0]
+
+    def submit(self, kind, total, work):
+        """
+        Start `work(job)` in a background thread. Returns the Job, or None
+        when max_running jobs are already in progress.
+        """
+        self._prune()
+        self._expire()
+        job = Job(self, uuid.uuid4().hex[:12], kind)
+        now = time.time()
+        with self._write() as con:
+            if con.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", ACTIVE).fetchone()[0] \
+                    >= self.max_running:
+                return None
+            con.execute(
+                "INSERT INTO jobs (id, kind, total, status, created, lease) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job.id, kind, total, now, now),
+            )
+        threading.Thread(target=self._run, args=(job, work), name=f"job-{job.id}", daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        row = self._row(job_id)
+        return Job(self, row[0], row[1]) if row else None
+
+    def list(self):
+        self._expire()
+        rows = self._read().execute(f"SELECT {COLUMNS} FROM jobs ORDER BY created").fetchall()
+        return [_progress(row) for row in rows]
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_seconds
+        with self._write() as con:
+            con.execute("DELETE FROM jobs WHERE finished < ?", (cutoff,))
+            con.execute("DELETE FROM job_results WHERE job NOT IN (SELECT id FROM jobs)")
+
+    def _renew(self, job, stop):
+        """
+        Keep the lease of a running job and pick up cancel requests from
+        other workers.
+        """
+        while not stop.wait(LEASE_RENEW):
+            try:
+                with self._write() as con:
+                    con.execute("UPDATE jobs SET lease = ? WHERE id = ?", (time.time(), job.id))
+                    row = con.execute("SELECT cancelled FROM jobs WHERE id = ?", (job.id,)).fetchone()
+                if row and row[0]:
+                    job.cancelled = True
+            except sqlite3.OperationalError:
+                pass   # busy; the next round renews it
+
+    def _run(self, job, work):
+        stop = threading.Event()
+        threading.Thread(target=self._renew, args=(job, stop), name=f"job-{job.id}-lease", daemon=True).start()
+        job._flush(status="running", started=time.time())
+        try:
+            results = work(job)
+            # the work decides where to stop on cancel, so every result it
+            # reports (e.g. every committed row) is kept
+            for result in results:
+                job._add(result)
+            job._flush(status="cancelled" if job.cancelled else "done", finished=time.time())
+        except Exception as e:
+            job._flush(status="failed", error=f"{type(e).__name__}: {e}", finished=time.time())
+        finally:
+            stop.set()
+
+
+class _Immediate:
+    """
+    `with` block running as one BEGIN IMMEDIATE transaction.
+    """
+
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        self.con.execute("BEGIN IMMEDIATE")
+        return self.con
+
+    def __exit__(self, exc_type, exc, tb):
+        self.con.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+###############################################################################
+# Server-sent events
+###############################################################################
+
+def _event(name, data, event_id=None):
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def stream_events(job, last_event_id=None):
+    """
+    SSE text chunks for `job`, starting after result number `last_event_id`.
+    """
+    seen = int(last_event_id) + 1 if last_event_id not in (None, "") else 0
+    yield "retry: 2000\n\n"
+    yield _event("progress", job.progress())
+    last_progress = last_output = time.monotonic()
+
+    while True:
+        progress = job.progress()   # read before the results so none are missed
+        finished = progress is None or progress["status"] not in ACTIVE
+        start, results = job._results_after(seen)
+        for offset, result in enumerate(results):
+            yield _event("result", result, event_id=start + offset)
+        if results:
+            seen = start + len(results)
+            last_output = time.monotonic()
+            if finished:
+                continue   # drain what's left before the end event
+
+        now = time.monotonic()
+        if finished:
+            progress = job.progress()
+            yield _event("progress", progress)
+            yield _event("end", {"status": progress["status"] if progress else "gone",
+                                 "error": progress["error"] if progress else None})
+            return
+        if results and now - last_progress >= PROGRESS_INTERVAL:
+            yield _event("progress", progress)
+            last_progress = last_output = now
+        elif now - last_output >= HEARTBEAT_INTERVAL:
+            yield ": keep-alive\n\n"
+            last_output = now
+        if not results:
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,356 @@
+# kb_snapshot.py
+# -*- coding: utf-8 -*-
+"""
+Read-only, memory-mapped snapshot of the compiled meal/rule tables.
+
+CompactPlan turns meal ids back into text (expand) and text into ids
+(from_plan) under one of 192 dress codes (condition set x goal swaps).
+Without a snapshot every worker computes those texts on demand and keeps
+them in its own LRU caches. The snapshot precomputes all of them once, in
+one file:
+
+  header   magic "DPKB", format, VOCAB_CRC, source digest, counts, offsets
+  strings  uint32 offsets[n + 1] + UTF-8 bytes (each distinct text once)
+  dressed  uint16 string id per (dress code, meal id), portion not included
+  lookup   open-addressing table of (crc32(text), dress, meal id) entries
+           answering "which meal is this text under this dress?"
+
+Workers mmap the file read-only and index it through typed memoryviews,
+so every worker shares the same page-cache pages instead of holding a
+copy; only the last STRING_CACHE decoded texts are kept per process.
+
+  python kb_snapshot.py build [kb_snapshot.bin]   # atomic (re)build
+  python kb_snapshot.py check [kb_snapshot.bin]   # is it current?
+  python kb_snapshot.py bench [--workers 4]       # per-worker RSS/PSS, with and without
+
+The digest covers the generator and compact_plan sources, so a snapshot
+built from other rules or dressing code is refused, and the caller falls
+back to computing. build() writes a temp file and renames it over the old
+one. Readers re-stat the path every RELOAD_INTERVAL seconds and map the
+new file when it changes. A mapping that is already open stays valid
+until it is dropped.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from functools import lru_cache
+from pathlib import Path
+
+import compact_plan
+import diet_generator
+from compact_plan import MEAL_VOCAB, SWAP_GOALS, COND_KEYS, VOCAB_CRC, _dress_rules
+from diet_generator import _apply_avoids_and_swaps
+
+SNAPSHOT_PATH = Path("kb_snapshot.bin")
+FORMAT_VERSION = 1
+RELOAD_INTERVAL = 5.0   # s between checks for a swapped file
+STRING_CACHE = 256      # decoded texts kept per process (a few dozen KiB)
+
+N_DRESS = len(SWAP_GOALS) << len(COND_KEYS)
+EMPTY = 0xFFFF
+
+# magic, format, vocab crc, digest, n_dress, n_meals, n_strings, lookup size,
+# then offsets of strings, dressed, lookup
+_HEADER = struct.Struct("<4sHI8sHHIIIII")
+_ENTRY = struct.Struct("<IHH")   # crc32(text), dress, meal id
+
+
+def source_digest():
+    """
+    Digest of everything a dressed text depends on: rules, vocab and code.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(struct.pack("<HI", FORMAT_VERSION, VOCAB_CRC))
+    for module in (diet_generator, compact_plan):
+        h.update(Path(module.__file__).read_bytes())
+    return h.digest()
+
+
+def _slot(crc, dress, mask):
+    return (crc ^ (dress * 0x9E3779B1)) & mask
+
+
+###############################################################################
+# Build
+###############################################################################
+
+def build(path=SNAPSHOT_PATH):
+    """
+    Compute every dressed text and write the snapshot atomically.
+    Returns the file size.
+    """
+    path = Path(path)
+    strings = []
+    string_id = {}
+
+    def intern(text):
+        if text not in string_id:
+            string_id[text] = len(strings)
+            strings.append(text)
+        return string_id[text]
+
+    n_meals = len(MEAL_VOCAB)
+    dressed = []
+    for dress in range(N_DRESS):
+        avoids, swaps = _dress_rules(dress)
+        for item in MEAL_VOCAB:
+            # slot/portion are appended at read time, exactly like _dress_meal
+            dressed.append(intern(_apply_avoids_and_swaps(item, avoids, swaps)))
+    if len(strings) >= EMPTY:
+        raise ValueError("too many distinct texts for 16-bit ids")
+
+    size = 1
+    while size < 2 * len(dressed):
+        size <<= 1
+    table = [None] * size
+    encoded = [s.encode("utf-8") for s in strings]
+    crcs = [zlib.crc32(raw) for raw in encoded]
+    for dress in range(N_DRESS):
+        seen = set()
+        # highest id first, so equal texts resolve like a {text: id} dict would
+        for item in reversed(range(n_meals)):
+            sid = dressed[dress * n_meals + item]
+            if sid in seen:
+                continue
+            seen.add(sid)
+            i = _slot(crcs[sid], dress, size - 1)
+            while table[i] is not None:
+                i = (i + 1) & (size - 1)
+            table[i] = (crcs[sid], dress, item)
+
+    blob_offsets = [0]
+    for raw in encoded:
+        blob_offsets.append(blob_offsets[-1] + len(raw))
+    strings_part = struct.pack(f"<{len(blob_offsets)}I", *blob_offsets) + b"".join(encoded)
+    dressed_part = struct.pack(f"<{len(dressed)}H", *dressed)
+    lookup_part = b"".join(_ENTRY.pack(*(e or (0, 0, EMPTY))) for e in table)
+
+    off_strings = _HEADER.size
+    off_dressed = off_strings + len(strings_part)
+    off_dressed += -off_dressed % 4
+    off_lookup = off_dressed + len(dressed_part)
+    off_lookup += -off_lookup % 8
+    header = _HEADER.pack(b"DPKB", FORMAT_VERSION, VOCAB_CRC, source_digest(), N_DRESS, n_meals,
+                          len(strings), size, off_strings, off_dressed, off_lookup)
+
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.write(strings_part)
+        f.write(b"\0" * (off_dressed - f.tell()))
+        f.write(dressed_part)
+        f.write(b"\0" * (off_lookup - f.tell()))
+        f.write(lookup_part)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)   # readers see the old file or the new one, never half
+    return path.stat().st_size
+
+
+###############################################################################
+# Read side
+###############################################################################
+
+class KnowledgeBase:
+    """
+    One mapped snapshot file. Raises ValueError if it does not match the
+    running code.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, crc, digest, n_dress, n_meals, n_strings, size,
+         self.off_strings, self.off_dressed, self.off_lookup) = _HEADER.unpack_from(self.mm, 0)
+        if magic != b"DPKB" or version != FORMAT_VERSION:
+            raise ValueError(f"{path}: not a knowledge-base snapshot")
+        if crc != VOCAB_CRC or digest != source_digest() or n_dress != N_DRESS or n_meals != len(MEAL_VOCAB):
+            raise ValueError(f"{path}: built from different rules or code; rebuild it")
+        if sys.byteorder != "little":
+            raise ValueError(f"{path}: snapshot tables are little-endian")
+        self.n_meals = n_meals
+        self.mask = size - 1
+        # typed views straight onto the mapped pages: indexing them copies
+        # nothing. Only the STRING_CACHE most recent decoded texts stay in
+        # this process; the full table lives once, in the page cache.
+        view = memoryview(self.mm)
+        off_blob = self.off_strings + 4 * (n_strings + 1)
+        self._offsets = view[self.off_strings:off_blob].cast("I")
+        self._blob = view[off_blob:]
+        self._dressed = view[self.off_dressed:self.off_dressed + 2 * n_dress * n_meals].cast("H")
+        # two uint32 per entry: crc32, then dress | meal id << 16
+        self._lookup = view[self.off_lookup:self.off_lookup + _ENTRY.size * size].cast("I")
+        self.string = lru_cache(maxsize=STRING_CACHE)(self._decode)
+
+    def _decode(self, sid):
+        return str(self._blob[self._offsets[sid]:self._offsets[sid + 1]], "utf-8")
+
+    def dressed(self, dress, item_id):
+        """
+        Bank item `item_id` with the avoids/swaps of `dress` applied.
+        """
+        return self.string(self._dressed[dress * self.n_meals + item_id])
+
+    def find(self, dress, text):
+        """
+        Meal id whose dressed text under `dress` is `text`, or None.
+        """
+        raw = text.encode("utf-8")
+        crc = zlib.crc32(raw)
+        lookup = self._lookup
+        i = _slot(crc, dress, self.mask)
+        while True:
+            packed = lookup[2 * i + 1]
+            item = packed >> 16
+            if item == EMPTY:
+                return None
+            if lookup[2 * i] == crc and packed & 0xFFFF == dress and self.dressed(dress, item) == text:
+                return item
+            i = (i + 1) & self.mask
+
+
+class SharedSnapshot:
+    """
+    Handle compact_plan reads through; remaps the file after an atomic swap.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = Path(path)
+        self.kb = KnowledgeBase(self.path)
+        self._next_check = time.monotonic() + RELOAD_INTERVAL
+
+    def current(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + RELOAD_INTERVAL
+            try:
+                st = os.stat(self.path)
+                if (st.st_ino, st.st_mtime_ns) != (self.kb.stat.st_ino, self.kb.stat.st_mtime_ns):
+                    self.kb = KnowledgeBase(self.path)
+            except (OSError, ValueError):
+                pass   # keep serving the mapping we have
+        return self.kb
+
+
+def is_current(path=SNAPSHOT_PATH):
+    try:
+        KnowledgeBase(path)
+        return True
+    except (OSError, ValueError, struct.error):
+        return False
+
+
+def activate(path=SNAPSHOT_PATH, rebuild=True):
+    """
+    Map the snapshot for compact_plan (building it first if missing or
+    stale and `rebuild`). Returns the handle, or None if it could not be used.
+    """
+    if not is_current(path):
+        if not rebuild:
+            return None
+        build(path)
+    try:
+        handle = SharedSnapshot(path)
+    except (OSError, ValueError):
+        return None
+    compact_plan.SNAPSHOT = handle
+    return handle
+
+
+###############################################################################
+# Memory comparison: N forked workers with and without the snapshot
+###############################################################################
+
+def _memory_kb():
+    """
+    (Rss, Pss, Private) of this process in KiB, from /proc/self/smaps_rollup.
+    """
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields.get("Rss", 0), fields.get("Pss", 0), \
+        fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+
+
+def _worker_traffic():
+    """
+    Generate, compact and re-expand a plan for every condition set x goal x
+    portion, i.e. every (dress code, portion) a worker can meet.
+    """
+    import itertools
+    import random
+    from compact_plan import CompactPlan
+    from diet_generator import generate_plan
+    from warmup import COND_FIELDS
+    random.seed(0)
+    for mask, goal, weight in itertools.product(range(1 << len(COND_FIELDS)), SWAP_GOALS, (45, 70, 95)):
+        profile = {"age": 35, "weight": weight, "height": 170, "goal": goal, "diet_pref": "both"}
+        for bit, (field, value) in enumerate(COND_FIELDS.values()):
+            if mask >> bit & 1:
+                profile[field] = value
+        plan, prof = generate_plan(profile)
+        if CompactPlan.from_plan(plan, prof).expand() != plan:
+            raise AssertionError("compact plan round trip changed the plan")
+
+
+def _bench(workers, use_snapshot, path):
+    import gc
+    if use_snapshot:
+        activate(path)
+    else:
+        compact_plan.SNAPSHOT = None
+    gc.collect()
+    gc.freeze()
+    pipes = []
+    for _ in range(workers):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            _worker_traffic()
+            os.write(w, ("%d %d %d" % _memory_kb()).encode())
+            time.sleep(0.5)   # stay alive while the siblings measure
+            os._exit(0)
+        os.close(w)
+        pipes.append((pid, r))
+    results = []
+    for pid, r in pipes:
+        results.append(tuple(int(x) for x in os.read(r, 100).split()))
+        os.close(r)
+        os.waitpid(pid, 0)
+    gc.unfreeze()
+    rss, pss, private = (sum(col) / len(results) for col in zip(*results))
+    label = "snapshot" if use_snapshot else "in-process caches"
+    print(f"{label:<18} per worker: RSS {rss / 1024:6.1f} MiB  PSS {pss / 1024:6.1f} MiB  "
+          f"private {private / 1024:6.1f} MiB")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Meal/rule knowledge-base snapshot.")
+    parser.add_argument("command", choices=("build", "check", "bench"))
+    parser.add_argument("path", nargs="?", default=str(SNAPSHOT_PATH))
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        size = build(args.path)
+        print(f"{args.path}: {size / 1024:.0f} KiB in {(time.perf_counter() - started) * 1000:.0f} ms")
+    elif args.command == "check":
+        ok = is_current(args.path)
+        print(f"{args.path}: {'current' if ok else 'missing or stale'}")
+        sys.exit(0 if ok else 1)
+    else:
+        # import what a worker imports, so the baseline is realistic
+        import app  # noqa: F401
+        _bench(args.workers, False, args.path)
+        _bench(args.workers, True, args.path)
@@ -0,0 +1,257 @@
+# plan_store.py
+# -*- coding: utf-8 -*-
+"""
+Content-addressed plan storage.
+
+Plans are stored once, keyed by a hash of their content, and user_cases
+rows point at them through `plan_hash`. Each plan is split into its parts
+(diet grid, exercise list, notes), and each part is itself stored once in
+plan_blobs. The exercise list and notes repeat across most users even
+when the meal grid differs, so near-identical plans share most of their
+bytes too.
+
+  plan_blobs(hash -> body)                               canonical JSON
+  plans(hash -> diet_hash, exercise_hash, notes_hash, rest_hash)
+
+Writes are insert-if-absent, so identical content costs one index probe.
+`python plan_store.py migrate [db]` moves existing inline `plan` JSON into
+the store and reports the size change. `python plan_store.py redress [db]`
+then re-dresses plans saved before base_meals with today's avoid/swap
+rules (see diet_generator.upgrade_plan).
+"""
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+DB_PATH = Path("database.db")
+
+# plan key -> plans column; anything else in a plan goes to rest_hash
+PARTS = (
+    ("diet_plan", "diet_hash"),
+    ("exercise_plan", "exercise_hash"),
+    ("notes", "notes_hash"),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plan_blobs (
+    hash TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS plans (
+    hash TEXT PRIMARY KEY,
+    diet_hash TEXT,
+    exercise_hash TEXT,
+    notes_hash TEXT,
+    rest_hash TEXT
+) WITHOUT ROWID;
+"""
+
+_READ = """
+SELECT d.body, e.body, n.body, r.body
+FROM plans p
+LEFT JOIN plan_blobs d ON d.hash = p.diet_hash
+LEFT JOIN plan_blobs e ON e.hash = p.exercise_hash
+LEFT JOIN plan_blobs n ON n.hash = p.notes_hash
+LEFT JOIN plan_blobs r ON r.hash = p.rest_hash
+WHERE p.hash = ?
+"""
+
+
+def init_plan_store(con):
+    con.executescript(SCHEMA)
+    columns = [row[1] for row in con.execute("PRAGMA table_info(user_cases)")]
+    if "plan_hash" not in columns:
+        con.execute("ALTER TABLE user_cases ADD COLUMN plan_hash TEXT")
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def put_plan(con, plan):
+    """
+    Store `plan` (insert-if-absent) and return its hash. Runs inside the
+    caller's transaction.
+    """
+    blobs = []
+    hashes = []
+    rest = {k: v for k, v in plan.items() if k not in dict(PARTS)}
+    for value in [plan.get(key) for key, _ in PARTS] + [rest or None]:
+        if value is None:
+            hashes.append(None)
+            continue
+        body = _canonical(value)
+        h = _digest(body)
+        blobs.append((h, body))
+        hashes.append(h)
+
+    plan_hash = _digest("|".join(h or "" for h in hashes))
+    con.executemany("INSERT OR IGNORE INTO plan_blobs (hash, body) VALUES (?, ?)", blobs)
+    con.execute(
+        "INSERT OR IGNORE INTO plans (hash, diet_hash, exercise_hash, notes_hash, rest_hash) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [plan_hash] + hashes,
+    )
+    return plan_hash
+
+
+def get_plan(con, plan_hash):
+    row = con.execute(_READ, (plan_hash,)).fetchone()
+    if row is None:
+        return None
+    plan = json.loads(row[3]) if row[3] else {}
+    for (key, _), body in zip(PARTS, row[:3]):
+        if body is not None:
+            plan[key] = json.loads(body)
+    return plan
+
+
+def load_case_plan(con, case_id):
+    """
+    Plan of a stored case, whether deduplicated or still inline, hot or
+    archived.
+    """
+    row = con.execute("SELECT plan_hash, plan FROM user_cases WHERE id = ?", (case_id,)).fetchone()
+    if row is None:
+        from archive import get_case   # archive -> batch -> plan_store
+        case = get_case(con, case_id)
+        if case is None:
+            return None
+        row = (case.get("plan_hash"), case.get("plan"))
+    plan_hash, inline = row
+    plan = get_plan(con, plan_hash) if plan_hash else None
+    if plan is None and inline:
+        # archived cases carry their plan inline
+        plan = json.loads(inline)
+    return plan
+
+
+def gc_plans(con):
+    """
+    Drop plans (and then parts) no user_cases row points at any more, e.g.
+    after archiving. Returns (plans, blobs) removed. Runs inside the
+    caller's transaction.
+    """
+    plans = con.execute(
+        "DELETE FROM plans WHERE hash NOT IN "
+        "(SELECT plan_hash FROM user_cases WHERE plan_hash IS NOT NULL)"
+    ).rowcount
+    blobs = con.execute(
+        "DELETE FROM plan_blobs WHERE hash NOT IN ("
+        "SELECT diet_hash FROM plans WHERE diet_hash IS NOT NULL "
+        "UNION SELECT exercise_hash FROM plans WHERE exercise_hash IS NOT NULL "
+        "UNION SELECT notes_hash FROM plans WHERE notes_hash IS NOT NULL "
+        "UNION SELECT rest_hash FROM plans WHERE rest_hash IS NOT NULL)"
+    ).rowcount
+    return plans, blobs
+
+
+###############################################################################
+# Migration of inline plans
+###############################################################################
+
+def _db_size(con):
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    return con.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+
+def migrate(db_path=DB_PATH, batch=1000, vacuum=True, log=print):
+    """
+    Move inline user_cases.plan JSON into the store. Safe to re-run.
+    """
+    con = sqlite3.connect(db_path)
+    init_plan_store(con)
+    con.commit()
+    before = _db_size(con)
+
+    moved = 0
+    while True:
+        rows = con.execute(
+            "SELECT id, plan FROM user_cases WHERE plan_hash IS NULL AND plan IS NOT NULL LIMIT ?",
+            (batch,),
+        ).fetchall()
+        if not rows:
+            break
+        with con:
+            updates = []
+            for case_id, inline in rows:
+                try:
+                    plan = json.loads(inline)
+                except ValueError:
+                    plan = None
+                if not isinstance(plan, dict):
+                    plan = {"raw": inline}
+                updates.append((put_plan(con, plan), case_id))
+            con.executemany("UPDATE user_cases SET plan_hash = ?, plan = NULL WHERE id = ?", updates)
+        moved += len(rows)
+
+    if vacuum:
+        con.execute("VACUUM")
+    after = _db_size(con)
+    n_plans = con.execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+    n_blobs = con.execute("SELECT COUNT(*) FROM plan_blobs").fetchone()[0]
+    con.close()
+    log(f"moved {moved} cases -> {n_plans} plans / {n_blobs} blobs; "
+        f"db {before / 1024:.0f} KiB -> {after / 1024:.0f} KiB")
+    return moved
+
+
+def redress(db_path=DB_PATH, batch=1000, log=print):
+    """
+    Point every stored case whose plan predates base_meals at the same
+    picks dressed by today's rules. Needs the case's stored profile; inline
+    plans are left for migrate(), archived cases stay frozen. Safe to re-run.
+    """
+    from diet_generator import upgrade_plan
+
+    con = sqlite3.connect(db_path)
+    init_plan_store(con)
+    con.commit()
+
+    last_id = 0
+    scanned = changed = 0
+    while True:
+        rows = con.execute(
+            "SELECT id, plan_hash, profile FROM user_cases "
+            "WHERE id > ? AND plan_hash IS NOT NULL AND profile IS NOT NULL ORDER BY id LIMIT ?",
+            (last_id, batch),
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        scanned += len(rows)
+        with con:
+            updates = []
+            for case_id, plan_hash, profile in rows:
+                plan = get_plan(con, plan_hash)
+                if not plan or "base_meals" in plan or "members" in plan:
+                    continue
+                try:
+                    profile = json.loads(profile)
+                except ValueError:
+                    continue
+                upgraded = upgrade_plan(plan, profile)
+                new_hash = put_plan(con, upgraded)
+                if new_hash != plan_hash:
+                    updates.append((new_hash, case_id))
+            con.executemany("UPDATE user_cases SET plan_hash = ? WHERE id = ?", updates)
+        changed += len(updates)
+
+    with con:
+        removed, _ = gc_plans(con)
+    con.close()
+    log(f"redressed {changed} of {scanned} cases; {removed} old plans dropped")
+    return changed
+
+
+if __name__ == "__main__":
+    import sys
+    commands = {"migrate": migrate, "redress": redress}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.exit("usage: python plan_store.py migrate|redress [database.db]")
+    commands[sys.argv[1]](sys.argv[2] if len(sys.argv) > 2 else DB_PATH)
@@ -0,0 +1,279 @@
+# profile_schema.py
+# -*- coding: utf-8 -*-
+"""
+Single parse/validate step for the submit form.
+
+parse_form() turns raw form fields into a __slots__ Profile with
+enum-coded choices, BMI/weight class and a parsed allergy set. It raises
+ProfileError (-> HTTP 400) on the first bad field, before any plan work
+is done. generate_plan accepts a Profile directly and skips its own
+normalisation.
+"""
+from dataclasses import dataclass
+from enum import Enum
+
+from utils import calc_bmi, weight_class_from_bmi
+
+
+class ProfileError(ValueError):
+    """
+    Bad or missing form input; str(err) is safe to show to the user.
+    """
+
+
+###############################################################################
+# Enum-coded choices (values are what the form posts, lower-cased)
+###############################################################################
+
+class Gender(str, Enum):
+    FEMALE = "female"
+    MALE = "male"
+    OTHER = "other"
+
+class Level(str, Enum):
+    LOW = "low"
+    MEDIUM = "medium"
+    HIGH = "high"
+
+class WorkType(str, Enum):
+    SEDENTARY = "sedentary"
+    ACTIVE = "active"
+    FIELD = "field"
+    HOMEMAKER = "homemaker"
+
+class BP(str, Enum):
+    NORMAL = "normal"
+    HIGH = "high"
+    LOW = "low"
+
+class Sugar(str, Enum):
+    NONE = "none"
+    PREDIABETIC = "prediabetic"
+    DIABETIC = "diabetic"
+
+class Thyroid(str, Enum):
+    NONE = "none"
+    HYPO = "hypo"
+    HYPER = "hyper"
+
+class YesNo(str, Enum):
+    NO = "no"
+    YES = "yes"
+
+class Cholesterol(str, Enum):
+    NORMAL = "normal"
+    HIGH = "high"
+
+class Pregnancy(str, Enum):
+    NA = "na"
+    NO = "no"
+    YES = "yes"
+
+class DietPref(str, Enum):
+    VEG = "veg"
+    NONVEG = "nonveg"
+    VEGAN = "vegan"
+    BOTH = "both"
+
+class Goal(str, Enum):
+    WEIGHT_LOSS = "weight_loss"
+    WEIGHT_GAIN = "weight_gain"
+    FITNESS = "fitness"
+    MUSCLE = "muscle"
+    DISEASE_CONTROL = "disease_control"
+
+
+# form spellings that differ from the canonical value
+ALIASES = {
+    DietPref: {"non-veg": DietPref.NONVEG},
+}
+
+# raw form value -> member, built once so parsing is a dict lookup
+_LOOKUP = {
+    enum: {**{e.value: e for e in enum}, **ALIASES.get(enum, {})}
+    for enum in (Gender, Level, WorkType, BP, Sugar, Thyroid, YesNo,
+                 Cholesterol, Pregnancy, DietPref, Goal)
+}
+
+MAX_NAME = 100
+MAX_ALLERGIES = 20
+MAX_ALLERGY_TEXT = 500
+
+
+###############################################################################
+# Profile
+###############################################################################
+
+@dataclass(slots=True)
+class Profile:
+    name: str
+    age: int
+    gender: Gender
+    weight: float
+    height: float
+    sleep: float
+    activity: Level
+    stress: Level
+    work_type: WorkType
+    goal: Goal
+    diet_pref: DietPref
+    allergies: frozenset
+    bp: BP
+    sugar: Sugar
+    thyroid: Thyroid
+    pcod: YesNo
+    cholesterol: Cholesterol
+    heart: YesNo
+    kidney: YesNo
+    pregnancy: Pregnancy
+    bmi: float
+    weight_class: str
+
+    def to_dict(self):
+        """
+        Plain dict (enum values, sorted allergy list) for session/DB/templates.
+        """
+        out = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, Enum):
+                value = value.value
+            elif isinstance(value, frozenset):
+                value = sorted(value)
+            out[name] = value
+        return out
+
+
+###############################################################################
+# Parsing
+###############################################################################
+
+def _text(form, key):
+    # form fields are strings; JSON bodies may carry numbers
+    value = form.get(key)
+    return "" if value is None else str(value).strip()
+
+
+def _number(form, key, kind, lo, hi, label):
+    raw = _text(form, key)
+    if not raw:
+        raise ProfileError(f"{label} is required")
+    try:
+        value = kind(raw)
+    except ValueError:
+        raise ProfileError(f"{label} must be a number")
+    if value != value or not lo <= value <= hi:  # NaN or out of range
+        raise ProfileError(f"{label} must be between {lo} and {hi}")
+    return value
+
+
+def _choice(form, key, enum, default, label):
+    raw = _text(form, key).lower()
+    if not raw:
+        return default
+    member = _LOOKUP[enum].get(raw)
+    if member is None:
+        allowed = ", ".join(e.value for e in enum)
+        raise ProfileError(f"{label} must be one of: {allowed}")
+    return member
+
+
+def _allergies(form):
+    raw = form.get("allergies") or ""
+    if isinstance(raw, (list, tuple)):
+        raw = ",".join(str(a) for a in raw)
+    raw = raw.strip()
+    if len(raw) > MAX_ALLERGY_TEXT:
+        raise ProfileError(f"Allergies must be at most {MAX_ALLERGY_TEXT} characters")
+    items = frozenset(a.strip().lower() for a in raw.split(",") if a.strip())
+    if len(items) > MAX_ALLERGIES:
+        raise ProfileError(f"At most {MAX_ALLERGIES} allergies can be listed")
+    return items
+
+
+def parse_form(form):
+    """
+    Validate the submit form and return a Profile. Raises ProfileError.
+    """
+    name = _text(form, "name")
+    if len(name) > MAX_NAME:
+        raise ProfileError(f"Name must be at most {MAX_NAME} characters")
+
+    age = _number(form, "age", int, 1, 120, "Age")
+    weight = _number(form, "weight", float, 2, 400, "Weight (kg)")
+    height = _number(form, "height", float, 40, 250, "Height (cm)")
+    sleep = _number(form, "sleep", float, 0, 24, "Sleep (hours)")
+    bmi = calc_bmi(weight, height)
+
+    return Profile(
+        name=name,
+        age=age,
+        gender=_choice(form, "gender", Gender, Gender.OTHER, "Gender"),
+        weight=weight,
+        height=height,
+        sleep=sleep,
+        activity=_choice(form, "activity", Level, Level.LOW, "Activity"),
+        stress=_choice(form, "stress", Level, Level.LOW, "Stress"),
+        work_type=_choice(form, "work_type", WorkType, WorkType.SEDENTARY, "Work type"),
+        goal=_choice(form, "goal", Goal, Goal.FITNESS, "Goal"),
+        diet_pref=_choice(form, "diet_pref", DietPref, DietPref.BOTH, "Diet preference"),
+        allergies=_allergies(form),
+        bp=_choice(form, "bp", BP, BP.NORMAL, "Blood pressure"),
+        sugar=_choice(form, "sugar", Sugar, Sugar.NONE, "Sugar"),
+        thyroid=_choice(form, "thyroid", Thyroid, Thyroid.NONE, "Thyroid"),
+        pcod=_choice(form, "pcod", YesNo, YesNo.NO, "PCOD/PCOS"),
+        cholesterol=_choice(form, "cholesterol", Cholesterol, Cholesterol.NORMAL, "Cholesterol"),
+        heart=_choice(form, "heart", YesNo, YesNo.NO, "Heart condition"),
+        kidney=_choice(form, "kidney", YesNo, YesNo.NO, "Kidney issues"),
+        pregnancy=_choice(form, "pregnancy", Pregnancy, Pregnancy.NA, "Pregnancy"),
+        bmi=bmi,
+        # same labels generate_plan uses ("Underweight", "Normal", ...)
+        weight_class=weight_class_from_bmi(bmi).capitalize(),
+    )
+
+
+###############################################################################
+# Normalisation cost: old ad-hoc path vs. parse once
+###############################################################################
+if __name__ == "__main__":
+    from timeit import timeit
+    import profile_schema  # the class generate_plan checks against, not __main__'s copy
+    from diet_generator import _profile_context
+
+    form = {
+        "name": "Test", "age": "32", "gender": "female", "weight": "78", "height": "164",
+        "sleep": "6.5", "activity": "low", "stress": "high", "work_type": "sedentary",
+        "goal": "weight_loss", "diet_pref": "Both", "allergies": "lactose, peanuts",
+        "bp": "high", "sugar": "prediabetic", "thyroid": "hypo", "pcod": "yes",
+        "cholesterol": "high", "heart": "no", "kidney": "no", "pregnancy": "no",
+    }
+
+    def old_path():
+        profile = {
+            "name": form.get("name", "").strip(),
+            "age": int(form.get("age") or 0),
+            "gender": form.get("gender", ""),
+            "weight": float(form.get("weight") or 0),
+            "height": float(form.get("height") or 0),
+            "sleep": float(form.get("sleep") or 0),
+            "activity": form.get("activity", "low"),
+            "stress": form.get("stress", "low"),
+            "work_type": form.get("work_type", ""),
+            "goal": form.get("goal", "fitness").lower(),
+            "diet_pref": (form.get("diet_pref") or "both").lower(),
+            "allergies": [a.strip().lower() for a in form.get("allergies", "").split(",") if a.strip()],
+        }
+        for key, default in (("bp", "normal"), ("sugar", "none"), ("thyroid", "none"), ("pcod", "no"),
+                             ("cholesterol", "normal"), ("heart", "no"), ("kidney", "no"),
+                             ("pregnancy", "na")):
+            profile[key] = form.get(key, default).lower()
+        return _profile_context(profile)
+
+    def new_path():
+        return _profile_context(profile_schema.parse_form(form))
+
+    assert old_path() == new_path()
+    n = 20000
+    print(f"ad-hoc parse + generator normalisation : {timeit(old_path, number=n) / n * 1e6:6.2f} us")
+    print(f"parse_form + context from Profile      : {timeit(new_path, number=n) / n * 1e6:6.2f} us")
+    print(f"parse_form alone                       : {timeit(lambda: profile_schema.parse_form(form), number=n) / n * 1e6:6.2f} us")
@@ -0,0 +1,103 @@
+# profiling.py
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-request cProfile capture.
+
+A request is profiled when
+  - PROFILE_SAMPLE_RATE > 0 and it is picked by sampling, or
+  - it sends the PROFILE_HEADER (default "X-Profile") with the value of
+    PROFILE_TOKEN (header triggering is off while PROFILE_TOKEN is unset).
+
+Each capture is written as a .pstats file to PROFILE_DIR (only the newest
+PROFILE_KEEP files are kept) and the top PROFILE_TOP functions by
+cumulative time are logged. Files load in `python -m pstats`, snakeviz,
+or flameprof for a flamegraph. The response gets an X-Profile-Id header
+naming the file.
+
+Only one request per process is profiled at a time: since Python 3.12
+cProfile hooks are process-wide and a second enable() from another thread
+(gunicorn threads) raises ValueError. A request picked while another is
+being profiled is served unprofiled.
+"""
+import cProfile
+import io
+import pstats
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+from flask import g, request
+
+_ACTIVE = threading.Lock()   # held while a request of this process is profiled
+
+
+def _wanted(app):
+    token = app.config["PROFILE_TOKEN"]
+    if token and request.headers.get(app.config["PROFILE_HEADER"]) == token:
+        return True
+    rate = app.config["PROFILE_SAMPLE_RATE"]
+    return rate > 0 and random.random() < rate
+
+
+def _prune(directory, keep):
+    files = sorted(directory.glob("*.pstats"), key=lambda p: p.stat().st_mtime)
+    for old in files[:-keep] if keep else files:
+        old.unlink(missing_ok=True)
+
+
+def init_profiling(app):
+    app.config.setdefault("PROFILE_SAMPLE_RATE", 0.0)
+    app.config.setdefault("PROFILE_HEADER", "X-Profile")
+    app.config.setdefault("PROFILE_TOKEN", None)
+    app.config.setdefault("PROFILE_DIR", "profiles")
+    app.config.setdefault("PROFILE_KEEP", 50)
+    app.config.setdefault("PROFILE_TOP", 15)
+
+    @app.before_request
+    def _start_profile():
+        if request.endpoint == "static" or not _wanted(app):
+            return
+        if not _ACTIVE.acquire(blocking=False):
+            return
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # another profiler (not ours) is active in this process
+            _ACTIVE.release()
+            return
+        g._profiler = prof
+        g._profile_started = time.perf_counter()
+
+    @app.after_request
+    def _finish_profile(response):
+        prof = g.pop("_profiler", None)
+        if prof is None:
+            return response
+        prof.disable()
+        _ACTIVE.release()
+        elapsed_ms = (time.perf_counter() - g.pop("_profile_started")) * 1000
+
+        directory = Path(app.config["PROFILE_DIR"])
+        directory.mkdir(parents=True, exist_ok=True)
+        endpoint = re.sub(r"[^A-Za-z0-9_]", "_", request.endpoint or "unknown")
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{elapsed_ms:.0f}ms-{random.getrandbits(24):06x}.pstats"
+        prof.dump_stats(directory / name)
+        _prune(directory, app.config["PROFILE_KEEP"])
+
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(app.config["PROFILE_TOP"])
+        app.logger.warning("profile %s %s %.1f ms -> %s\n%s",
+                           request.method, request.path, elapsed_ms, name, out.getvalue())
+        response.headers["X-Profile-Id"] = name
+        return response
+
+    @app.teardown_request
+    def _drop_profile(exc):
+        # request failed before after_request ran: stop profiling, keep nothing
+        prof = g.pop("_profiler", None)
+        if prof is not None:
+            prof.disable()
+            _ACTIVE.release()
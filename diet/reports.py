@@ -0,0 +1,270 @@
+# reports.py
+# -*- coding: utf-8 -*-
+"""
+Pre-aggregated dashboard numbers over user_cases.
+
+Three small WITHOUT ROWID tables hold the counts, keyed exactly by what the
+dashboards group on, so reads never touch user_cases:
+
+  report_condition(condition)                 -> n
+  report_bmi(age_band, weight_class)          -> n, bmi_sum
+  report_goal_week(week, goal)                -> n
+
+refresh() folds in only rows with id above the stored watermark, so it is
+cheap to call before every read or from cron (`python reports.py`);
+refresh(full=True) rebuilds everything from scratch, archived cases
+(see archive.py) included. Each batch reads the watermark, folds and moves
+it inside one BEGIN IMMEDIATE transaction, so concurrent refreshes (every
+/reports request runs one) never count the same rows twice.
+"""
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from archive import iter_archived
+from batch import CASE_COLUMNS, profile_from_row
+from diet_generator import _profile_context
+from utils import calc_bmi, weight_class_from_bmi, age_band
+
+DB_PATH = Path("database.db")
+REFRESH_BATCH = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_condition (
+    condition TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS report_bmi (
+    age_band TEXT,
+    weight_class TEXT,
+    n INTEGER NOT NULL,
+    bmi_sum REAL NOT NULL,
+    PRIMARY KEY (age_band, weight_class)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS report_goal_week (
+    week TEXT,
+    goal TEXT,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (week, goal)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS report_state (
+    name TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL,
+    refreshed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_user_cases_created_at ON user_cases(created_at);
+"""
+
+
+def init_reports(con):
+    con.executescript(SCHEMA)
+
+
+###############################################################################
+# Row -> report keys
+###############################################################################
+
+def _week_of(created_at):
+    try:
+        year, week, _ = datetime.fromisoformat(created_at).isocalendar()
+    except (TypeError, ValueError):
+        return "unknown"
+    return f"{year}-W{week:02d}"
+
+
+def _report_keys(row):
+    """
+    (conditions, age_band, weight_class, bmi, week, goal) for one case row.
+    """
+    profile = profile_from_row(row)
+    ctx = _profile_context(profile)
+    conditions = sorted(ctx["active_conditions"]) or ["none"]
+    bmi = calc_bmi(profile.get("weight") or 0, profile.get("height") or 0)
+    return (
+        conditions,
+        age_band(int(profile.get("age") or 0)),
+        weight_class_from_bmi(bmi),
+        bmi,
+        _week_of(row.get("created_at")),
+        ctx["goal"],
+    )
+
+
+###############################################################################
+# Refresh
+###############################################################################
+
+def _fold(con, rows, last_id=None):
+    """
+    Add row dicts to the aggregates; moves the watermark to `last_id` if given.
+    The caller holds the write transaction.
+    """
+    by_condition = Counter()
+    by_bmi = Counter()
+    bmi_sum = Counter()
+    by_goal = Counter()
+    for row in rows:
+        conditions, band, wclass, bmi, week, goal = _report_keys(row)
+        by_condition.update(conditions)
+        by_bmi[(band, wclass)] += 1
+        bmi_sum[(band, wclass)] += bmi
+        by_goal[(week, goal)] += 1
+
+    con.executemany(
+        "INSERT INTO report_condition (condition, n) VALUES (?, ?) "
+        "ON CONFLICT(condition) DO UPDATE SET n = n + excluded.n",
+        by_condition.items(),
+    )
+    con.executemany(
+        "INSERT INTO report_bmi (age_band, weight_class, n, bmi_sum) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(age_band, weight_class) DO UPDATE SET "
+        "n = n + excluded.n, bmi_sum = bmi_sum + excluded.bmi_sum",
+        [(band, wclass, n, bmi_sum[(band, wclass)]) for (band, wclass), n in by_bmi.items()],
+    )
+    con.executemany(
+        "INSERT INTO report_goal_week (week, goal, n) VALUES (?, ?, ?) "
+        "ON CONFLICT(week, goal) DO UPDATE SET n = n + excluded.n",
+        [(week, goal, n) for (week, goal), n in by_goal.items()],
+    )
+    if last_id is not None:
+        con.execute(
+            "INSERT OR REPLACE INTO report_state (name, last_id, refreshed_at) VALUES ('user_cases', ?, ?)",
+            (last_id, datetime.now().isoformat()),
+        )
+
+
+def _fold_next(con, columns):
+    """
+    Fold the next REFRESH_BATCH hot rows after the watermark; returns how
+    many. Must run inside the write transaction that also read the watermark.
+    """
+    row = con.execute("SELECT last_id FROM report_state WHERE name = 'user_cases'").fetchone()
+    rows = con.execute(
+        f"SELECT {', '.join(columns)} FROM user_cases WHERE id > ? ORDER BY id LIMIT ?",
+        (row[0] if row else 0, REFRESH_BATCH),
+    ).fetchall()
+    if rows:
+        _fold(con, [dict(zip(columns, values)) for values in rows], rows[-1][0])
+    return len(rows)
+
+
+def _rebuild(con, columns):
+    """
+    Clear the aggregates and fold archived plus hot rows; caller holds the
+    write transaction, so no catch-up can interleave with the empty tables.
+    """
+    con.execute("DELETE FROM report_condition")
+    con.execute("DELETE FROM report_bmi")
+    con.execute("DELETE FROM report_goal_week")
+    con.execute("DELETE FROM report_state")
+    added = 0
+    batch = []
+    for record in iter_archived(con):
+        batch.append(record)
+        if len(batch) >= REFRESH_BATCH:
+            _fold(con, batch)
+            added += len(batch)
+            batch = []
+    if batch:
+        _fold(con, batch)
+        added += len(batch)
+    while True:
+        n = _fold_next(con, columns)
+        if not n:
+            return added
+        added += n
+
+
+def refresh(con, full=False):
+    """
+    Fold new user_cases rows into the aggregates. Returns rows added.
+    full=True rebuilds from archived cases plus every hot row.
+    """
+    init_reports(con)
+    has_profile = any(r[1] == "profile" for r in con.execute("PRAGMA table_info(user_cases)"))
+    columns = CASE_COLUMNS + ("created_at",) + (("profile",) if has_profile else ())
+
+    added = 0
+    while True:
+        # take the write lock before reading the watermark: a second refresh
+        # waits here and then sees the rows this one folded as already done
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            n = _rebuild(con, columns) if full else _fold_next(con, columns)
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+        added += n
+        if full or not n:
+            return added
+
+
+###############################################################################
+# Query API
+###############################################################################
+
+def cases_by_condition(con):
+    rows = con.execute("SELECT condition, n FROM report_condition ORDER BY n DESC, condition")
+    return {condition: n for condition, n in rows}
+
+
+def bmi_by_age_band(con):
+    """
+    {age_band: {weight_class: n, ..., "mean_bmi": x}}
+    """
+    out = {}
+    totals = Counter()
+    sums = Counter()
+    for band, wclass, n, total in con.execute(
+        "SELECT age_band, weight_class, n, bmi_sum FROM report_bmi ORDER BY age_band, weight_class"
+    ):
+        out.setdefault(band, {})[wclass] = n
+        totals[band] += n
+        sums[band] += total
+    for band in out:
+        out[band]["mean_bmi"] = round(sums[band] / totals[band], 2) if totals[band] else 0.0
+    return out
+
+
+def goal_mix_by_week(con, weeks=12):
+    """
+    {week: {goal: n}} for the most recent `weeks` ISO weeks with data.
+    """
+    recent = [w for (w,) in con.execute(
+        "SELECT DISTINCT week FROM report_goal_week ORDER BY week DESC LIMIT ?", (weeks,)
+    )]
+    out = {week: {} for week in sorted(recent)}
+    if recent:
+        marks = ", ".join("?" * len(recent))
+        for week, goal, n in con.execute(
+            f"SELECT week, goal, n FROM report_goal_week WHERE week IN ({marks})", recent
+        ):
+            out[week][goal] = n
+    return out
+
+
+def summary(db_path=DB_PATH, weeks=12):
+    """
+    Catch up on new rows, then return all dashboard aggregates.
+    """
+    con = sqlite3.connect(db_path)
+    try:
+        refresh(con)
+        return {
+            "cases_by_condition": cases_by_condition(con),
+            "bmi_by_age_band": bmi_by_age_band(con),
+            "goal_mix_by_week": goal_mix_by_week(con, weeks),
+        }
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    import sys
+    args = [a for a in sys.argv[1:] if a != "--full"]
+    con = sqlite3.connect(args[0] if args else DB_PATH)
+    full = "--full" in sys.argv
+    print(f"folded {refresh(con, full=full)} rows into report tables")
+    con.close()
@@ -0,0 +1,113 @@
+# warmup.py
+# -*- coding: utf-8 -*-
+"""
+Warm-up run before a worker takes traffic.
+
+warm_up(app) maps the knowledge-base snapshot (kb_snapshot.py), building
+it first if it is missing or stale, so compact plans read dressed meal
+texts from one shared file instead of per-worker caches. Then it
+generates and compacts representative plans across condition/goal/
+preference combinations, which warms the generator and dress-rule
+caches. Rendering the templates once compiles them and fills the
+static/template fingerprints, and a throwaway PDF loads the fallback
+fonts.
+
+With gunicorn `preload_app` it runs once in the master (see
+gunicorn.conf.py), followed by gc.freeze(), so every forked worker
+shares the warmed structures copy-on-write. Without preload each
+worker runs it in post_worker_init. /ready reports 503 until it is done.
+"""
+import gc
+import itertools
+import random
+import time
+from io import BytesIO
+
+from flask import render_template
+from reportlab.pdfgen import canvas
+
+from diet_generator import generate_plan
+from compact_plan import CompactPlan, COND_KEYS, SWAP_GOALS, _dress_rules
+import kb_snapshot
+
+STATE = {"ready": False, "warmup_ms": None, "plans": 0, "kb_snapshot": False}
+
+GOALS = ("fitness", "weight_loss", "weight_gain", "muscle")
+PREFS = ("veg", "nonveg", "vegan", "both")
+WEIGHTS = (45, 70, 95)   # underweight / normal / obese at 170 cm
+# form field + value that switches each condition on
+COND_FIELDS = {
+    "diabetes": ("sugar", "diabetic"),
+    "bp_or_heart": ("bp", "high"),
+    "thyroid": ("thyroid", "hypo"),
+    "kidney": ("kidney", "yes"),
+    "pcod": ("pcod", "yes"),
+    "pregnancy": ("pregnancy", "yes"),
+}
+
+
+def _sample_profiles():
+    """
+    One condition at a time (plus none and all) x goal x preference x BMI.
+    """
+    condition_sets = [()] + [(key,) for key in COND_FIELDS] + [tuple(COND_FIELDS)]
+    for conds, goal, pref, weight in itertools.product(condition_sets, GOALS, PREFS, WEIGHTS):
+        profile = {"age": 35, "weight": weight, "height": 170, "goal": goal, "diet_pref": pref}
+        for key in conds:
+            field, value = COND_FIELDS[key]
+            profile[field] = value
+        yield profile
+
+
+def warm_up(app, freeze=False):
+    """
+    Idempotent; returns the warm-up time in ms.
+    """
+    if STATE["ready"]:
+        return STATE["warmup_ms"]
+    started = time.perf_counter()
+
+    # every avoid/swap rule set the compact form can reference
+    for mask in range(1 << len(COND_KEYS)):
+        for goal in range(len(SWAP_GOALS)):
+            _dress_rules(mask | (goal << 6))
+
+    # with preload the master maps it and forked workers inherit the mapping;
+    # if it can't be built (read-only dir) compact plans fall back to caches
+    try:
+        STATE["kb_snapshot"] = kb_snapshot.activate(app.config.get("KB_SNAPSHOT", kb_snapshot.SNAPSHOT_PATH)) is not None
+    except OSError as e:
+        app.logger.warning("knowledge-base snapshot unavailable: %s", e)
+
+    # keep the plan RNG stream untouched for the first real request
+    rng_state = random.getstate()
+    plans = 0
+    sample = None
+    for profile in _sample_profiles():
+        plan, prof = generate_plan(profile)
+        CompactPlan.from_plan(plan, prof).expand()
+        sample = sample or (plan, prof)
+        plans += 1
+    random.setstate(rng_state)
+
+    # compile + render templates once (url_for/asset fingerprints included)
+    with app.test_request_context("/"):
+        render_template("index.html")
+        plan, prof = sample
+        render_template("result.html", plan=plan, profile=prof, plan_source="warm-up")
+
+    # reportlab loads its font metrics on first use
+    c = canvas.Canvas(BytesIO())
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(50, 50, "warm-up")
+    c.save()
+
+    if freeze:
+        # move everything allocated so far out of GC tracking, so collections
+        # in the workers don't write to (and un-share) the master's pages
+        gc.collect()
+        gc.freeze()
+
+    STATE.update(ready=True, plans=plans, warmup_ms=round((time.perf_counter() - started) * 1000, 1))
+    app.logger.warning("warm-up done: %d plans in %.1f ms", plans, STATE["warmup_ms"])
+    return STATE["warmup_ms"]